@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# 基于规范流水（format_transactions的结果）的分析方法
+from __future__ import annotations
+import statics as st
+from core import np, pd, format_progress, get_amount_array, get_yuan_array
+
+
+# 为每笔流水生成账户编码：同一银行的同一账号（无账号时用卡号）为一个账户
+def get_account_codes(df: pd.DataFrame) -> np.ndarray:
+    keys = df.reindex(columns=['银行名称', '账号', '卡号'])
+    keys['账号'] = keys['账号'].fillna(keys['卡号'])
+    return keys.groupby(['银行名称', '账号'], sort=False,
+                        dropna=False).ngroup().to_numpy()
+
+
+# 将流水按（账户, 交易时间）排序，返回排序下标和可直接二分查找的组合键：
+# 账户编码 * 跨度 + 相对秒数，跨度大于时间范围加最大窗口，保证查找不会越过账户边界
+def get_sorted_account_keys(codes: np.ndarray, seconds: np.ndarray,
+                            max_window: int) -> (np.ndarray, np.ndarray):
+    order = np.lexsort((seconds, codes))
+    if len(order) == 0:
+        return order, np.empty(0, dtype=np.int64)
+    offsets = seconds - seconds.min()
+    span = offsets.max() + max_window + 1
+    return order, codes[order].astype(np.int64) * span + offsets[order]
+
+
+# 在排序后的组合键上计算每笔流水之前window秒内（含本笔）的笔数和values之和
+def rolling_window(keys: np.ndarray, values: np.ndarray,
+                   window: int) -> (np.ndarray, np.ndarray):
+    starts = np.searchsorted(keys, keys - window, side='right')
+    ends = np.arange(1, len(keys) + 1)
+    sums = np.concatenate(([0], np.cumsum(values)))
+    return ends - starts, sums[ends] - sums[starts]
+
+
+# 计算各账户的滚动窗口特征并打分，返回风险分大于0的流水（按风险分降序）。
+# 特征包括1/7/30天内的笔数、收入、支出及收支比，整额交易，大额现金，
+# 以及快进快出（转出前pass_hours小时内转入金额不少于转出金额的PASS_THROUGH_RATIO）
+def score_anomalies(df: pd.DataFrame, pass_hours: int = None) -> pd.DataFrame:
+    format_progress('开始计算异常交易评分……')
+    pass_hours = pass_hours or st.PASS_THROUGH_HOURS
+    df = df[df['交易日期'].notna()]
+    codes = get_account_codes(df)
+    seconds = df['交易日期'].to_numpy(
+        dtype='datetime64[ns]').view('int64') // 10**9
+    windows = {'{}天'.format(_days): _days * 86400 for _days in st.ANOMALY_WINDOWS}
+    order, keys = get_sorted_account_keys(
+        codes, seconds, max(list(windows.values()) + [pass_hours * 3600]))
+    amounts = get_yuan_array(df['交易金额'])[order]
+    incomes = np.where(amounts > 0, amounts, 0)
+    expenses = np.where(amounts < 0, -amounts, 0)
+
+    features = {}
+    for name, window in windows.items():
+        features[name + '笔数'], features[name + '收入'] = rolling_window(
+            keys, incomes, window)
+        features[name + '支出'] = rolling_window(keys, expenses, window)[1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            features[name + '收支比'] = np.nan_to_num(
+                np.minimum(features[name + '收入'], features[name + '支出']) /
+                np.maximum(features[name + '收入'], features[name + '支出']))
+    abs_amounts = np.abs(amounts)
+    cash_lines = np.zeros(len(df), dtype=bool)
+    for col in st.CASH_COLS:
+        if col in df.columns:
+            cash_lines |= df[col].str.contains(st.CASH_PATTERN,
+                                               na=False).to_numpy()
+    flags = {
+        '整额':
+        (abs_amounts >= st.ROUND_AMOUNT_MIN) &
+        (np.mod(abs_amounts, st.ROUND_AMOUNT_UNIT) == 0),
+        '高频':
+        features['{}天笔数'.format(st.ANOMALY_WINDOWS[0])] >=
+        st.HIGH_FREQUENCY_COUNT,
+        '大额现金': (abs_amounts >= st.LARGE_CASH_AMOUNT) & cash_lines[order],
+        '快进快出': (expenses > 0) & (rolling_window(
+            keys, incomes, pass_hours * 3600)[1] >=
+                                  expenses * st.PASS_THROUGH_RATIO),
+    }
+    _ratio_window = '{}天'.format(st.ANOMALY_WINDOWS[1])
+    flags['资金过渡'] = ((features[_ratio_window + '收支比'] >=
+                      st.BALANCED_FLOW_RATIO) &
+                     (features[_ratio_window + '支出'] >= st.LARGE_FLOW_AMOUNT))
+
+    scores = np.zeros(len(order), dtype=np.int32)
+    marks = np.full(len(order), '', dtype=object)
+    for name, flag in flags.items():
+        scores += flag * st.ANOMALY_WEIGHTS[name]
+        marks = marks + np.where(flag, name + ' ', '')
+    alerts = scores > 0
+    result = df.iloc[order[alerts]].reindex(columns=[
+        '银行名称', '户名', '账号', '卡号', '交易日期', '交易金额', '对方户名', '对方账号', '摘要'
+    ])
+    result.insert(0, '风险标记', pd.Series(marks[alerts]).str.rstrip().to_numpy())
+    result.insert(0, '风险分', scores[alerts])
+    for name, feature in features.items():
+        result[name] = feature[alerts]
+    result.sort_values(by='风险分', ascending=False, kind='stable', inplace=True)
+    format_progress('异常交易评分完成，预警流水{}条'.format(len(result)))
+    return result
+
+
+# 将若干[起点, 终点)区间展开为下标数组，同时返回各区间的长度
+def expand_ranges(lows: np.ndarray,
+                  highs: np.ndarray) -> (np.ndarray, np.ndarray):
+    lengths = highs - lows
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return np.repeat(lows - offsets, lengths) + np.arange(lengths.sum()), lengths
+
+
+# 资金追踪：将账号、卡号和对方账号统一编码，为各账户的转出流水建立按时间排序的索引。
+# 从种子转出流水出发，逐层在对方账户的转出流水中二分查找时间窗口内金额相近的交易
+class FundTracer:
+    def __init__(self, df: pd.DataFrame) -> None:
+        self.df = df
+        accounts = df.reindex(columns=['账号', '卡号', '对方账号'])
+        codes = pd.factorize(
+            pd.concat([accounts[col] for col in accounts.columns],
+                      ignore_index=True).astype(object).str.strip())[0]
+        acc_codes, card_codes, self.target_codes = np.split(codes, 3)
+        dates = df['交易日期'].to_numpy(dtype='datetime64[ns]')
+        self.valid_dates = ~np.isnat(dates)
+        seconds = dates.view('int64') // 10**9
+        self.offsets = np.zeros(len(df), dtype=np.int64)
+        if self.valid_dates.any():
+            self.offsets[self.valid_dates] = (
+                seconds[self.valid_dates] - seconds[self.valid_dates].min())
+        # 组合键的跨度，查询上限截断到跨度以内，保证不越过账户边界
+        self.span = self.offsets.max() + 1
+        self.amounts = -get_amount_array(df['交易金额'])
+        out_lines = np.flatnonzero((self.amounts > 0) & self.valid_dates)
+        # 同一笔转出流水分别以账号和卡号建立索引
+        _card_lines = out_lines[(card_codes[out_lines] >= 0)
+                                & (card_codes[out_lines] != acc_codes[out_lines])]
+        _acc_lines = out_lines[acc_codes[out_lines] >= 0]
+        index_lines = np.concatenate((_acc_lines, _card_lines))
+        index_accs = np.concatenate(
+            (acc_codes[_acc_lines], card_codes[_card_lines])).astype(np.int64)
+        order = np.lexsort((self.offsets[index_lines], index_accs))
+        self.index_lines = index_lines[order]
+        self.index_keys = (index_accs[order] * self.span +
+                           self.offsets[self.index_lines])
+
+    # 从种子流水（df的索引标签）出发追踪hops层，返回追踪树，每行为一个节点：
+    # 下一层为对方账户在上层交易后window_hours小时内、金额相差不超过amount_tolerance比例的转出。
+    # 每笔流水在树中只出现一次
+    def trace(self,
+              seeds: list,
+              hops: int = None,
+              window_hours: float = None,
+              amount_tolerance: float = None) -> pd.DataFrame:
+        hops = hops or st.TRACE_HOPS
+        window = int((window_hours or st.TRACE_WINDOW_HOURS) * 3600)
+        amount_tolerance = amount_tolerance or st.TRACE_AMOUNT_TOLERANCE
+        frontier = self.df.index.get_indexer(seeds)
+        frontier = frontier[frontier >= 0]
+        lines, parents, levels = [frontier], [np.full(len(frontier), -1)], [
+            np.zeros(len(frontier), dtype=int)
+        ]
+        frontier_nodes = np.arange(len(frontier))
+        visited = np.zeros(len(self.df), dtype=bool)
+        visited[frontier] = True
+        for level in range(1, hops + 1):
+            frontier_nodes = frontier_nodes[(self.target_codes[frontier] >= 0)
+                                            & self.valid_dates[frontier]]
+            frontier = frontier[(self.target_codes[frontier] >= 0)
+                                & self.valid_dates[frontier]]
+            bases = self.target_codes[frontier].astype(np.int64) * self.span
+            lows = np.searchsorted(self.index_keys,
+                                   bases + self.offsets[frontier])
+            highs = np.searchsorted(self.index_keys,
+                                    bases + np.minimum(
+                                        self.offsets[frontier] + window,
+                                        self.span - 1),
+                                    side='right')
+            positions, lengths = expand_ranges(lows, highs)
+            next_lines = self.index_lines[positions]
+            next_parents = np.repeat(frontier_nodes, lengths)
+            parent_amounts = np.repeat(self.amounts[frontier], lengths)
+            matched = (np.abs(self.amounts[next_lines] - parent_amounts) <=
+                       parent_amounts * amount_tolerance) & ~visited[next_lines]
+            next_lines, next_parents = next_lines[matched], next_parents[matched]
+            # 同一笔流水可能被多个上层节点命中，只保留第一个
+            _first = np.sort(np.unique(next_lines, return_index=True)[1])
+            next_lines, next_parents = next_lines[_first], next_parents[_first]
+            if len(next_lines) == 0:
+                break
+            visited[next_lines] = True
+            node_num = sum(len(_lines) for _lines in lines)
+            frontier = next_lines
+            frontier_nodes = np.arange(node_num, node_num + len(next_lines))
+            lines.append(next_lines)
+            parents.append(next_parents)
+            levels.append(np.full(len(next_lines), level))
+        lines = np.concatenate(lines)
+        tree = self.df.iloc[lines].reindex(columns=[
+            '户名', '账号', '卡号', '交易日期', '交易金额', '对方户名', '对方账号'
+        ]).reset_index(drop=True)
+        tree.insert(0, '流水索引', self.df.index[lines])
+        tree.insert(0, '上级节点', np.concatenate(parents))
+        tree.insert(0, '层级', np.concatenate(levels))
+        tree.insert(0, '节点', np.arange(len(lines)))
+        return tree
+
+
+# 规范化名称：全角转半角（NFKC），删除空白和标点，统一公司类型写法，字母转大写
+def normalize_names(names: pd.Series) -> pd.Series:
+    names = names.str.normalize('NFKC').str.replace(st.NAME_STRIP_PATTERN,
+                                                    '',
+                                                    regex=True)
+    for old, new in st.NAME_REPLACEMENTS:
+        names = names.str.replace(old, new, regex=False)
+    return names.str.upper()
+
+
+# 将各名称拆分为不重复的字符n-gram，n-gram统一编码为整数。
+# 返回按名称分段、段内升序的n-gram编码，以及各段的起点和长度
+def get_name_grams(names: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    n = st.NAME_NGRAM
+    owners = np.repeat(np.arange(len(names), dtype=np.int64),
+                       [max(len(name) - n + 1, 1) for name in names])
+    gram_ids, gram_names = pd.factorize(
+        [name[i:i + n] for name in names
+         for i in range(max(len(name) - n + 1, 1))])
+    keys = np.unique(owners * len(gram_names) + gram_ids)
+    owners, gram_ids = np.divmod(keys, len(gram_names))
+    counts = np.bincount(owners, minlength=len(names))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return gram_ids, starts, counts
+
+
+# 计算各名称n-gram集合的MinHash签名，每行一个名称。
+# 每个哈希函数对全部n-gram计算一次后按名称分段取最小值
+def get_minhash_signatures(gram_ids: np.ndarray,
+                           starts: np.ndarray) -> np.ndarray:
+    prime = 2**31 - 1
+    rng = np.random.default_rng(0)
+    perm_num = st.NAME_LSH_BANDS * st.NAME_LSH_ROWS
+    mults = rng.integers(1, prime, perm_num)
+    adds = rng.integers(0, prime, perm_num)
+    signatures = np.empty((len(starts), perm_num), dtype=np.int64)
+    for k in range(perm_num):
+        signatures[:, k] = np.minimum.reduceat(
+            (mults[k] * gram_ids + adds[k]) % prime, starts)
+    return signatures
+
+
+# LSH分段：签名的每一段完全相同的名称落入同一个桶，桶内每个名称与其后
+# 至多NAME_LSH_MAX_PAIRS个名称组成候选对，返回去重后的候选对（左编号小于右编号）
+def get_candidate_pairs(signatures: np.ndarray) -> (np.ndarray, np.ndarray):
+    rows = st.NAME_LSH_ROWS
+    pairs = []
+    for band in range(st.NAME_LSH_BANDS):
+        keys = np.ascontiguousarray(signatures[:, band * rows:(band + 1) *
+                                               rows]).view(
+                                                   np.dtype((np.void, 8 * rows)))
+        buckets = np.unique(keys.ravel(), return_inverse=True)[1]
+        order = np.argsort(buckets, kind='stable')
+        buckets = buckets[order]
+        for offset in range(1, st.NAME_LSH_MAX_PAIRS + 1):
+            same = buckets[offset:] == buckets[:-offset]
+            if not same.any():  # 所有桶都不超过offset个名称
+                break
+            pairs.append(order[:-offset][same].astype(np.int64) *
+                         len(signatures) + order[offset:][same])
+    if len(pairs) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.divmod(np.unique(np.concatenate(pairs)), len(signatures))
+
+
+# 计算名称对n-gram集合的精确Jaccard相似度：将两侧n-gram以（对编号, n-gram）编码，
+# 排序后相邻相等的即为交集元素。分块计算以限制内存
+def get_jaccard(gram_ids: np.ndarray, starts: np.ndarray, counts: np.ndarray,
+                lefts: np.ndarray, rights: np.ndarray) -> np.ndarray:
+    gram_num = gram_ids.max() + 1 if len(gram_ids) > 0 else 1
+    similarities = np.empty(len(lefts))
+    for start in range(0, len(lefts), 2**16):
+        _lefts, _rights = lefts[start:start + 2**16], rights[start:start + 2**16]
+        keys = []
+        for names in (_lefts, _rights):
+            positions, lengths = expand_ranges(starts[names],
+                                               starts[names] + counts[names])
+            keys.append(
+                np.repeat(np.arange(len(names), dtype=np.int64), lengths) *
+                gram_num + gram_ids[positions])
+        keys = np.sort(np.concatenate(keys))
+        shared = np.bincount(keys[1:][keys[1:] == keys[:-1]] // gram_num,
+                             minlength=len(_lefts))
+        similarities[start:start + 2**16] = shared / (
+            counts[_lefts] + counts[_rights] - shared)
+    return similarities
+
+
+# 并查集：按名称对合并连通分量，每轮将两端的根挂到较小的根上并压缩路径，
+# 返回每个节点所在分量的根（分量内最小编号）
+def union_pairs(n: int, lefts: np.ndarray, rights: np.ndarray) -> np.ndarray:
+    parents = np.arange(n)
+    while True:
+        left_roots, right_roots = parents[lefts], parents[rights]
+        merging = left_roots != right_roots
+        if not merging.any():
+            return parents
+        np.minimum.at(parents,
+                      np.maximum(left_roots, right_roots)[merging],
+                      np.minimum(left_roots, right_roots)[merging])
+        while True:
+            _grand = parents[parents]
+            if (_grand == parents).all():
+                break
+            parents = _grand
+
+
+# 为全部不同的户名和对方户名建立模糊名称索引，以原始名称（去首尾空白）为索引，
+# 包括规范名称、主体编号和主体名称（主体内出现次数最多的原始名称）。
+# 规范名称相同的直接归为同一主体。较长的名称去除组织形式后缀后，用MinHash/LSH查找候选，
+# 按精确Jaccard相似度验证后归并
+def build_name_index(df: pd.DataFrame) -> pd.DataFrame:
+    format_progress('开始建立模糊户名索引……')
+    names = pd.concat([df[col] for col in ['户名', '对方户名'] if col in df.columns],
+                      ignore_index=True).dropna().astype(str).str.strip()
+    counts = names[names != ''].value_counts()
+    normalized = normalize_names(counts.index.to_series())
+    norm_codes, norm_names = pd.factorize(normalized)
+    cores = pd.Series(norm_names).str.replace(st.NAME_LEGAL_FORM_PATTERN,
+                                              '',
+                                              regex=True)
+    fuzzy = np.flatnonzero(cores.str.len().to_numpy() >= st.NAME_FUZZY_MIN_LENGTH)
+    roots = np.arange(len(norm_names))
+    if len(fuzzy) > 1:
+        gram_ids, starts, gram_counts = get_name_grams(cores.to_numpy()[fuzzy])
+        lefts, rights = get_candidate_pairs(
+            get_minhash_signatures(gram_ids, starts))
+        similar = get_jaccard(gram_ids, starts, gram_counts, lefts,
+                              rights) >= st.NAME_SIMILARITY
+        roots[fuzzy] = fuzzy[union_pairs(len(fuzzy), lefts[similar],
+                                         rights[similar])]
+    # 原始名称已按出现次数降序排列，各主体首次出现的名称即为主体名称
+    party_ids, party_roots = pd.factorize(roots[norm_codes])
+    first_names = counts.index[np.unique(party_ids, return_index=True)[1]]
+    index = pd.DataFrame(
+        {
+            '规范名称': normalized.to_numpy(),
+            '主体编号': party_ids,
+            '主体名称': first_names[party_ids],
+        },
+        index=counts.index)
+    format_progress('模糊户名索引建立完成，名称{}个，归并为主体{}个'.format(
+        len(index), len(party_roots)))
+    return index
+
+
+# 在流水中添加户名和对方户名的主体编号列，空户名的主体编号为空，返回模糊名称索引
+def add_party_ids(df: pd.DataFrame) -> pd.DataFrame:
+    index = build_name_index(df)
+    for col, id_col in [('户名', '主体编号'), ('对方户名', '对方主体编号')]:
+        if col in df.columns:
+            df[id_col] = df[col].str.strip().map(
+                index['主体编号']).astype('Int64')
+    return index
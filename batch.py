@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# 批量处理多个案件目录，用法：
+#   python batch.py 案件目录或通配符…… [-o 输出目录] [-j 进程数] [--fen]
+# 案件按文件总大小从大到小交给进程池，每个案件完整执行解析、补全对手户名、写出流水和汇总表，
+# 有账户基本情况表时再计算并核对余额。各案件的输出、处理日志和处理结果.json写入各自的目录，
+# 单个案件失败不影响其他案件。文件在受监控的子进程中解析，无法解析的文件被隔离并记入处理结果
+import argparse
+import contextlib
+import glob
+import json
+import pathlib
+import sys
+import time
+import traceback
+import statics as st
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+# 案件目录下所有文件的总大小，用于估计处理时间
+def get_case_size(case_dir: pathlib.Path) -> int:
+    return sum(_file.stat().st_size for _file in case_dir.rglob('*')
+               if _file.is_file())
+
+
+# 处理单个案件，在子进程中执行，返回处理结果摘要。fen为True时金额以分为单位
+def process_case(case_dir: pathlib.Path,
+                 output_dir: pathlib.Path,
+                 fen: bool = False) -> dict:
+    import core
+    st.SHEET_WORKERS = 1  # 案件之间已经并行，不再按工作表启动子进程
+    output_dir.mkdir(parents=True, exist_ok=True)
+    summary = {'案件': str(case_dir), '输出目录': str(output_dir), '状态': '成功'}
+    start = time.perf_counter()
+    with open(output_dir / '处理日志.txt', 'w', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            quarantined = []
+            summary['隔离文件'] = quarantined
+            tables = {}
+            transactions = core.format_transactions(case_dir,
+                                                    fen=fen,
+                                                    supervise=True,
+                                                    quarantined=quarantined,
+                                                    summary=tables)
+            core.fill_target_names(transactions)
+            core.write_excel(transactions, output_dir)
+            core.write_summary(tables, output_dir)
+            summary['银行'] = sorted(transactions['银行名称'].unique())
+            summary['流水条数'] = len(transactions)
+            if (case_dir / '账户基本情况表.xlsx').exists():
+                core.write_excel(core.count_balances(case_dir, fen=fen),
+                                 output_dir, 'b')
+                report = core.reconcile_balances(transactions, case_dir)
+                core.write_excel(report, output_dir, 'r')
+                summary['余额差异'] = len(report)
+        except Exception as e:
+            summary['状态'] = '失败'
+            summary['错误'] = repr(e)
+            traceback.print_exc(file=log)
+    summary['用时'] = round(time.perf_counter() - start, 1)
+    with open(output_dir / '处理结果.json', 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+# 用进程池处理案件，大案件优先。子进程异常退出导致进程池损坏时，
+# 未完成的案件在新进程池中重试一次，仍失败则记为失败
+def run_cases(cases: list,
+              output_root: pathlib.Path,
+              workers: int,
+              fen: bool = False) -> list:
+    summaries = []
+    attempts = {case_dir: 0 for case_dir, _ in cases}
+    pending = [case_dir for case_dir, _ in cases]
+    while pending:
+        broken = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    process_case, case_dir, case_dir if output_root is None
+                    else output_root / case_dir.name, fen): case_dir
+                for case_dir in pending
+            }
+            for future in as_completed(futures):
+                case_dir = futures[future]
+                try:
+                    summary = future.result()
+                except BrokenProcessPool as e:
+                    attempts[case_dir] += 1
+                    if attempts[case_dir] < 2:
+                        broken.append(case_dir)
+                        continue
+                    summary = {'案件': str(case_dir), '状态': '失败', '错误': repr(e)}
+                summaries.append(summary)
+                print('{}【{}】{}'.format('✔' if summary['状态'] == '成功' else '✘',
+                                        case_dir.name,
+                                        summary.get('错误', '')))
+        pending = broken
+    return summaries
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='批量处理多个案件目录中的银行流水')
+    parser.add_argument('cases', nargs='+', help='案件目录，支持通配符')
+    parser.add_argument('-o', '--output', type=pathlib.Path,
+                        help='输出根目录，各案件输出到其下同名子目录，默认输出到案件目录')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='并行进程数')
+    parser.add_argument('--fen', action='store_true', help='金额以分为单位的整数表示')
+    args = parser.parse_args(argv)
+
+    case_dirs = sorted({
+        pathlib.Path(_path)
+        for pattern in args.cases
+        for _path in (glob.glob(pattern) or [pattern])
+        if pathlib.Path(_path).is_dir()
+    })
+    if len(case_dirs) == 0:
+        print('未找到案件目录')
+        return 1
+    # 最长处理时间优先，缩短总用时
+    cases = sorted(((case_dir, get_case_size(case_dir)) for case_dir in case_dirs),
+                   key=lambda case: case[1],
+                   reverse=True)
+    print('开始处理案件{}个……'.format(len(cases)))
+    start = time.perf_counter()
+    summaries = run_cases(cases, args.output, args.jobs or st.SHEET_WORKERS,
+                          args.fen)
+    failed = [summary for summary in summaries if summary['状态'] != '成功']
+    result_dir = args.output or pathlib.Path.cwd()
+    result_dir.mkdir(parents=True, exist_ok=True)
+    with open(result_dir / '批处理结果.json', 'w', encoding='utf-8') as f:
+        json.dump(summaries, f, ensure_ascii=False, indent=2)
+    print('全部处理完成，用时{:.1f}秒，成功{}个，失败{}个'.format(
+        time.perf_counter() - start,
+        len(summaries) - len(failed), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# 性能基准，用法：python benchmark.py [基准名……]，不指定时运行全部基准。
+# 超出预算的基准以✘标出，此时返回码非0
+import subprocess
+import sys
+import time
+
+# 启动耗时预算（秒）：新进程中从导入core到首次调用简单函数，
+# 以及到首次调用format_balances（包括按需加载pandas）
+STARTUP_BUDGET = 0.2
+FIRST_CALL_BUDGET = 1.0
+STARTUP_RUNS = 5
+# 异常交易评分预算：每百万行流水的耗时（秒）
+ANOMALY_ROWS = 1000000
+ANOMALY_BUDGET = 10
+
+
+# 生成rows行、accounts个账户的随机规范流水
+def make_transactions(rows: int, accounts: int, seed: int = 0):
+    import pandas as pd
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    amounts = rng.integers(1, 10**6, rows) / 100 * rng.choice([-1, 1], rows)
+    return pd.DataFrame({
+        '银行名称': '工商银行',
+        '户名': '户名',
+        '账号': rng.integers(0, accounts, rows).astype(str),
+        '交易日期': pd.Timestamp('2020-01-01') + pd.to_timedelta(
+            rng.integers(0, 365 * 86400, rows), unit='s'),
+        '交易金额': amounts,
+        '对方户名': rng.integers(0, accounts, rows).astype(str),
+        '对方账号': rng.integers(0, accounts, rows).astype(str),
+        '交易方式': rng.choice(['网银', '柜面', 'ATM取现'], rows),
+    })
+
+
+def run_python(code: str) -> float:
+    output = subprocess.run([sys.executable, '-c', code],
+                            capture_output=True,
+                            text=True,
+                            check=True).stdout
+    return float(output.split()[-1])
+
+
+# 冷启动：导入core后不应加载pandas；分别计时首次调用不依赖pandas的函数和
+# 在小表上首次调用format_balances（包括加载pandas的全部耗时），取多次运行的最小值
+def bench_startup() -> bool:
+    eager = run_python('import sys\n'
+                       'import core\n'
+                       'print(int("pandas" in sys.modules))')
+    startup = min(
+        run_python('import time\n'
+                   't = time.perf_counter()\n'
+                   'import core\n'
+                   'core.get_account_name("张三流水", "流水")\n'
+                   'print(time.perf_counter() - t)')
+        for _ in range(STARTUP_RUNS))
+    first_call = min(
+        run_python('import time\n'
+                   't = time.perf_counter()\n'
+                   'import core\n'
+                   'core.format_balances(core.pd.DataFrame({\n'
+                   '    "户名": ["张三"], "银行": ["工商银行"],\n'
+                   '    "当前余额": ["美元12.50"], "卡号或账号": ["6222"]}))\n'
+                   'print(time.perf_counter() - t)')
+        for _ in range(STARTUP_RUNS))
+    bank_paras = min(
+        run_python('import time\n'
+                   't = time.perf_counter()\n'
+                   'import statics\n'
+                   'statics.BANK_PARAS["工商银行"]\n'
+                   'print(time.perf_counter() - t)')
+        for _ in range(STARTUP_RUNS))
+    pandas_ready = run_python('import time\n'
+                              't = time.perf_counter()\n'
+                              'import core\n'
+                              'core.pd.DataFrame\n'
+                              'print(time.perf_counter() - t)')
+    passed = (not eager and startup <= STARTUP_BUDGET
+              and first_call <= FIRST_CALL_BUDGET)
+    print('{}启动：导入core{}加载pandas，导入到首次调用{:.3f}秒（预算{}秒），'
+          '到首次调用format_balances{:.3f}秒（预算{}秒），'
+          '生成BANK_PARAS{:.3f}秒，加载pandas{:.3f}秒'.format(
+              '✔' if passed else '✘', '时即' if eager else '时未', startup,
+              STARTUP_BUDGET, first_call, FIRST_CALL_BUDGET, bank_paras,
+              pandas_ready))
+    return passed
+
+
+# 异常交易评分的吞吐量
+def bench_anomalies() -> bool:
+    import analysis
+    df = make_transactions(ANOMALY_ROWS, ANOMALY_ROWS // 1000)
+    start = time.perf_counter()
+    analysis.score_anomalies(df)
+    seconds = time.perf_counter() - start
+    budget = ANOMALY_BUDGET * ANOMALY_ROWS / 10**6
+    passed = seconds <= budget
+    print('{}异常交易评分：{}行用时{:.2f}秒（预算{}秒）'.format(
+        '✔' if passed else '✘', ANOMALY_ROWS, seconds, budget))
+    return passed
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'anomalies': bench_anomalies,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    start = time.perf_counter()
+    results = [BENCHMARKS[name]() for name in names]
+    print('基准运行完成，用时{:.1f}秒'.format(time.perf_counter() - start))
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# 行为检查，用法：python checks.py [检查名……]，不指定时运行全部检查。
+# 与golden.py的整体快照互补，用手工构造的小数据逐项核对关键函数的结果：
+# 以分为单位的金额解析、跨文件去重计数、余额不连续和收支存疑、资金追踪、模糊户名归并。
+# 不符的检查以✘标出并列出不符项，此时返回码非0
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import analysis
+import core
+
+
+# 比较结果与期望值，返回不符项的说明，相符时为空列表
+def compare(name: str, actual, expected) -> list:
+    if actual == expected:
+        return []
+    return ['{}：期望{}，实际{}'.format(name, expected, actual)]
+
+
+# 金额字符串解析为分：千分位、前置和后置负号、第三位小数四舍五入、无法解析的为空；
+# 解析结果除以100后应与原金额的数值一致
+def check_fen() -> list:
+    cases = {
+        '1,234.56': 123456,
+        '-1,234.56': -123456,
+        '12.3-': -1230,
+        '+7': 700,
+        ' 8 ': 800,
+        '.5': 50,
+        '0.005': 1,
+        '0.004': 0,
+        '-0.015': -2,
+        '金额': None,
+        '': None,
+    }
+    amounts = pd.Series(list(cases), dtype=object)
+    fen = core.parse_fen(amounts)
+    problems = compare('类型', str(fen.dtype), core.st.FEN_DTYPE)
+    for amount, value, expected in zip(cases, fen, cases.values()):
+        problems += compare(repr(amount), None if pd.isna(value) else int(value),
+                            expected)
+    # 往返：两位小数以内的金额解析后再还原，与原字符串的数值相同
+    yuan = ['1,234.56', '-1,234.56', '12.3-', '0.01', '-0.10', '99999999.99']
+    restored = core.parse_fen(pd.Series(yuan)).to_numpy(dtype=np.int64) / 100
+    for amount, value in zip(yuan, restored):
+        _amount = amount.replace(',', '')
+        if _amount.endswith('-'):
+            _amount = '-' + _amount[:-1]
+        problems += compare('往返' + amount, value, float(_amount))
+    # 数值列直接按分取整，求和为精确的整数
+    numbers = core.parse_fen(pd.Series([0.1, 0.2, -0.3]))
+    problems += compare('数值列求和', int(numbers.sum()), 0)
+    return problems
+
+
+# 跨文件去重：其他文件中已出现的交易剔除，同一文件内的相同交易保留，空白差异视为相同
+def check_dedup() -> list:
+    rows = [
+        ('a.xlsx', '2020-01-01 10:00', 100.0, '乙公司'),
+        ('a.xlsx', '2020-01-02 10:00', -50.0, '丙公司'),
+        ('b.xlsx', '2020-01-01 10:00', 100.0, '乙公司'),  # 与a重复
+        ('b.xlsx', '2020-01-03 10:00', 30.0, '丁公司'),
+        ('b.xlsx', '2020-01-03 10:00', 30.0, '丁公司'),  # 同一文件内，保留
+        ('c.xlsx', '2020-01-02 10:00', -50.0, '丙 公司'),  # 与a重复，空白不同
+        ('c.xlsx', '2020-01-03 10:00', 30.0, '丁公司'),  # 与b重复
+    ]
+    file_names = ['a.xlsx', 'b.xlsx', 'c.xlsx']
+    trans = pd.DataFrame({
+        '户名': '甲',
+        '账号': '6222',
+        '交易日期': pd.to_datetime([_row[1] for _row in rows]),
+        '交易金额': [_row[2] for _row in rows],
+        '对方户名': [_row[3] for _row in rows],
+    })
+    file_codes = np.array([file_names.index(_row[0]) for _row in rows])
+    kept, overlaps = core.drop_duplicate_trans(trans, file_codes, file_names)
+    problems = compare('保留行', list(kept.index), [0, 1, 3, 4])
+    problems += compare(
+        '重叠统计', dict(overlaps), {
+            ('a.xlsx', 'b.xlsx'): 1,
+            ('a.xlsx', 'c.xlsx'): 1,
+            ('b.xlsx', 'c.xlsx'): 1,
+        })
+    # 分为单位时结果相同
+    trans['交易金额'] = core.parse_fen(trans['交易金额'])
+    kept, _ = core.drop_duplicate_trans(trans, file_codes, file_names)
+    problems += compare('以分为单位保留行', list(kept.index), [0, 1, 3, 4])
+    return problems
+
+
+# 余额不连续：上笔余额+交易金额与本笔余额不符的行被报告；
+# 根据余额推断收支方向时，余额变化与金额不符的行在收支存疑列中标出
+def check_balance() -> list:
+    trans = pd.DataFrame({
+        '银行名称': '工商银行',
+        '账号': ['1', '1', '1', '2', '2'],
+        '卡号': None,
+        '币种': None,
+        '交易日期': pd.to_datetime(
+            ['2020-01-01', '2020-01-02', '2020-01-03', '2020-01-01', '2020-01-02']),
+        '交易金额': [100.0, -30.0, 20.0, 10.0, 5.0],
+        '账户余额': [100.0, 70.0, 95.0, 10.0, 15.0],
+    })
+    problems = []
+    for fen in (False, True):
+        _trans = trans.copy()
+        if fen:
+            for col in ('交易金额', '账户余额'):
+                _trans[col] = core.parse_fen(_trans[col])
+        result = core.reconcile_balances(_trans)
+        unit = 100 if fen else 1
+        problems += compare('不连续行' + ('（分）' if fen else ''),
+                            list(result['流水索引']), [2])
+        problems += compare('期望余额' + ('（分）' if fen else ''),
+                            list(result['期望余额']), [90 * unit])
+        problems += compare('差额' + ('（分）' if fen else ''), list(result['差额']),
+                            [5 * unit])
+    # 交易金额为绝对值，首笔交易保留原方向，第三笔余额增加15而金额为20
+    trans['交易金额'] = trans['交易金额'].abs()
+    trans['账户余额'] = [100.0, 70.0, 85.0, 10.0, 15.0]
+    ambiguous, heads = core.amount_set_minus(trans)
+    problems += compare('推断金额', list(trans['交易金额']), [100, -30, 20, 10, 5])
+    problems += compare('收支存疑', list(trans['收支存疑'].notna()),
+                        [False, False, True, False, False])
+    problems += compare('存疑及首笔行数', (ambiguous, heads), (1, 2))
+    return problems
+
+
+# 资金追踪：甲转乙、乙在时间窗口内转丙，金额相近的转出逐层追踪；
+# 超出时间窗口或金额相差过大的转出不在追踪树中
+def check_trace() -> list:
+    trans = pd.DataFrame({
+        '户名': ['甲', '乙', '乙', '乙', '丙'],
+        '账号': ['A', 'B', 'B', 'B', 'C'],
+        '交易日期': pd.to_datetime([
+            '2020-01-01 10:00', '2020-01-01 12:00', '2020-01-10 12:00',
+            '2020-01-01 13:00', '2020-01-02 09:00'
+        ]),
+        '交易金额': [-1000.0, -980.0, -1000.0, -500.0, -950.0],
+        '对方户名': ['乙', '丙', '丁', '戊', '己'],
+        '对方账号': ['B', 'C', 'D', 'E', 'F'],
+    })
+    tree = analysis.FundTracer(trans).trace([0], hops=3, window_hours=72,
+                                            amount_tolerance=0.1)
+    problems = compare('流水', list(tree['流水索引']), [0, 1, 4])
+    problems += compare('层级', list(tree['层级']), [0, 1, 2])
+    problems += compare('上级节点', list(tree['上级节点']), [-1, 0, 1])
+    return problems
+
+
+# 模糊户名归并：规范化后相同的写法直接归并，地名位置不同的同一公司经相似度归并；
+# 一字之差的不同公司（相似度低于阈值）不归并
+def check_names() -> list:
+    names = [
+        '北京星辰科技有限责任公司', '北京星辰科技有限公司', '北京 星辰科技（有限公司）',
+        '北京星辰信息科技发展有限公司', '星辰信息科技发展（北京）有限公司', '北京星晨信息科技发展有限公司',
+        '上海甲乙商贸有限公司', '上海甲丙商贸有限公司', '张三', '张 三'
+    ]
+    index = analysis.build_name_index(pd.DataFrame({'户名': names}))
+    party_ids = index.loc[names, '主体编号'].to_numpy()
+    problems = compare('规范化后相同', len(set(party_ids[:3])), 1)
+    problems += compare('相似度归并', party_ids[3] == party_ids[4], True)
+    problems += compare('星辰与星晨', party_ids[3] == party_ids[5], False)
+    problems += compare('甲乙与甲丙', party_ids[6] == party_ids[7], False)
+    problems += compare('张三', party_ids[8] == party_ids[9], True)
+    problems += compare('主体数', len(set(party_ids)), 6)
+    return problems
+
+
+# 各检查返回不符项的说明列表
+CHECKS = {
+    'fen': ('金额解析', check_fen),
+    'dedup': ('跨文件去重', check_dedup),
+    'balance': ('余额核对', check_balance),
+    'trace': ('资金追踪', check_trace),
+    'names': ('户名归并', check_names),
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(CHECKS)
+    start = time.perf_counter()
+    results = []
+    for name in names:
+        title, check = CHECKS[name]
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):  # 不显示被检查函数的进度提示
+                problems = check()
+        except Exception as e:  # 出错的检查不影响其他检查
+            problems = ['出错：{}: {}'.format(type(e).__name__, e)]
+        print('{}{}'.format('✘' if problems else '✔', title))
+        for problem in problems:
+            print('    ' + problem)
+        results.append(not problems)
+    print('检查完成，用时{:.1f}秒，通过{}项，未通过{}项'.format(
+        time.perf_counter() - start, sum(results),
+        len(results) - sum(results)))
+    sys.exit(0 if all(results) else 1)
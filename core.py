@@ -1,10 +1,109 @@
 # -*- coding: utf-8 -*-
-import pandas as pd
+from __future__ import annotations
+import collections
+import gzip
+import importlib
+import importlib.util
+import io
+import json
+import multiprocessing
+import os
 import pathlib
+import queue
+import sys
+import time
 import statics as st
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import List, Union
 
 
+# 延迟导入的模块，首次访问其属性时才真正导入，以加快启动
+class LazyModule:
+    def __init__(self, name: str) -> None:
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
+
+# 流水筛选条件。日期、账号和户名条件在每个工作表读入、表头映射后即应用，
+# 金额条件在该文件的金额列合并后应用，被排除的流水不参与格式化和合并
+class TransFilter:
+    def __init__(self,
+                 start_date: str = None,
+                 end_date: str = None,
+                 accounts: List[str] = None,
+                 names: List[str] = None,
+                 min_amount: float = None) -> None:
+        # 交易日期范围，包含起止两天，为None时不限
+        self.start_date = start_date
+        self.end_date = end_date
+        # 只保留账号或卡号在此列表中的流水
+        self.accounts = accounts
+        # 只保留户名在此列表中的流水
+        self.names = names
+        # 只保留金额绝对值不小于此数的流水
+        self.min_amount = min_amount
+
+    # 返回筛选后的流水
+    def apply(self, trans: pd.DataFrame) -> pd.DataFrame:
+        keep_lines = np.ones(len(trans), dtype=bool)
+        if self.start_date is not None or self.end_date is not None:
+            trans['交易日期'] = pd.to_datetime(trans['交易日期'], errors='coerce')
+            if self.start_date is not None:
+                keep_lines &= trans['交易日期'] >= pd.Timestamp(self.start_date)
+            if self.end_date is not None:
+                keep_lines &= trans['交易日期'] < (
+                    pd.Timestamp(self.end_date).normalize() +
+                    pd.Timedelta(days=1))
+        if self.accounts is not None:
+            # 没有卡号列的银行reindex得到全空的浮点列，统一转为字符串再比较
+            accounts = trans.reindex(columns=['账号', '卡号']).fillna('')
+            keep_lines &= (
+                accounts['账号'].astype(str).str.strip().isin(self.accounts)
+                | accounts['卡号'].astype(str).str.strip().isin(self.accounts))
+        if self.names is not None:
+            keep_lines &= trans['户名'].fillna('').astype(
+                str).str.strip().isin(self.names)
+        if self.min_amount is not None:
+            keep_lines &= np.abs(get_yuan_array(
+                trans['交易金额'])) >= self.min_amount
+        if keep_lines.all():
+            return trans
+        return trans[keep_lines]
+
+    # 对刚读入的工作表应用日期、账号和户名条件，返回筛选后的工作表。
+    # 此时金额列尚未合并，户名可能稍后才由文件名补全，相应条件留给apply处理
+    def apply_to_sheet(self, sheet: pd.DataFrame) -> pd.DataFrame:
+        keep_lines = np.ones(len(sheet), dtype=bool)
+        if self.start_date is not None or self.end_date is not None:
+            dates = pd.to_datetime(sheet['交易日期'], errors='coerce')
+            if self.start_date is not None:
+                keep_lines &= dates >= pd.Timestamp(self.start_date)
+            if self.end_date is not None:
+                keep_lines &= dates < (pd.Timestamp(self.end_date).normalize() +
+                                       pd.Timedelta(days=1))
+        if self.accounts is not None and ('账号' in sheet.columns or
+                                          '卡号' in sheet.columns):
+            accounts = sheet.reindex(columns=['账号', '卡号']).fillna('')
+            keep_lines &= (
+                accounts['账号'].astype(str).str.strip().isin(self.accounts)
+                | accounts['卡号'].astype(str).str.strip().isin(self.accounts))
+        if self.names is not None and '户名' in sheet.columns and (
+                not sheet['户名'].hasnans):
+            keep_lines &= sheet['户名'].astype(str).str.strip().isin(self.names)
+        if keep_lines.all():
+            return sheet
+        return sheet[keep_lines]
+
+
 def format_progress(msg: str, no_return: bool = False) -> None:
     if no_return:
         print(msg, end='')
@@ -16,20 +115,92 @@ def format_error(msg: str) -> None:
     print('\n   ✘════' + msg + '════', end='')
 
 
-# 在两列金额中，有空值则返回空值；没有空值则返回0值
+# 返回金额为空值或0值的行
 def get_none_or_zero_lines(amount_col: pd.Series) -> pd.Series:
     num = pd.to_numeric(amount_col)
-    num_na = num.isna()
-    if num_na.any():
-        return num_na
-    else:
-        return num == 0
+    # 空值与零值同等对待，否则结果取决于同一文件中是否恰好有空值行，
+    # 按日期等条件预筛后同一行的金额可能不同
+    return num.isna() | (num == 0)
+
+
+# 将金额字符串解析为以分为单位的整数：去除千分位逗号和空白，支持前置或后置负号，
+# 第三位小数四舍五入，无法解析的为空值
+def parse_fen(amounts: pd.Series) -> pd.Series:
+    if pd.api.types.is_numeric_dtype(amounts):
+        return (amounts * 100).round().astype(st.FEN_DTYPE)
+    parts = amounts.astype(str).str.replace(r'[\s,，]', '',
+                                            regex=True).str.extract(st.FEN_PATTERN)
+    matched = parts['元'].notna().to_numpy()
+    parts = parts[matched]
+    fen = parts['元'].str.zfill(1).astype(np.int64).to_numpy() * 100 + (
+        parts['角分'].fillna('').str.ljust(3, '0').str[:3].astype(
+            np.int64).to_numpy() + 5) // 10
+    fen[((parts['符号'] == '-') | (parts['后缀'] == '-')).to_numpy()] *= -1
+    values = np.zeros(len(amounts), dtype=np.int64)
+    values[matched] = fen
+    return pd.Series(pd.arrays.IntegerArray(values, ~matched),
+                     index=amounts.index,
+                     name=amounts.name)
+
+
+# 金额列是否以分为单位（format_transactions的fen选项）
+def is_fen(amounts: pd.Series) -> bool:
+    return amounts.dtype == st.FEN_DTYPE
+
+
+# 将金额列转为浮点数组，单位与原列相同，无法转换的为nan
+def get_amount_array(amounts: pd.Series) -> np.ndarray:
+    if is_fen(amounts):
+        return amounts.to_numpy(dtype=float, na_value=np.nan)
+    return pd.to_numeric(amounts, errors='coerce').to_numpy(dtype=float)
+
+
+# 将金额列转为以元为单位的浮点数组，用于与以元为单位的阈值比较
+def get_yuan_array(amounts: pd.Series) -> np.ndarray:
+    if is_fen(amounts):
+        return get_amount_array(amounts) / 100
+    return get_amount_array(amounts)
+
+
+# 没有收付标志时，将同一账户同一币种的交易按时间稳定排序，根据相邻余额之差判断收支方向。
+# 返回各行的余额变化（各账户首笔交易没有上笔余额，为nan）、余额变化与交易金额不符的行，
+# 以及各账户首笔交易的行
+def get_balance_changes(
+        trans: pd.DataFrame) -> (np.ndarray, np.ndarray, np.ndarray):
+    keys = trans.reindex(columns=['账号', '卡号', '币种'])
+    keys['账号'] = keys['账号'].fillna(keys['卡号'])
+    # 多币种账户的各币种余额各自连续，须分开比较
+    keys['币种'] = np.asarray(normalize_currency(keys['币种']), dtype=object)
+    codes = keys.groupby(['账号', '币种'], sort=False,
+                         dropna=False).ngroup().to_numpy()
+    dates = trans['交易日期'].to_numpy(dtype='datetime64[ns]').view('int64')
+    order = np.lexsort((dates, codes))
+    codes = codes[order]
+    balances = get_amount_array(trans['账户余额'])[order]
+    amounts = get_amount_array(trans['交易金额'])[order]
+    tolerance = 0 if is_fen(trans['交易金额']) else st.BALANCE_TOLERANCE
+    diffs = np.full(len(order), np.nan)
+    diffs[1:] = balances[1:] - balances[:-1]
+    heads = np.ones(len(order), dtype=bool)  # 各账户的首笔交易
+    heads[1:] = codes[1:] != codes[:-1]
+    diffs[heads] = np.nan
+    mismatched = ~heads & ~(np.abs(np.abs(diffs) - np.abs(amounts)) <= tolerance)
+    changes = np.empty(len(order))
+    changes[order] = diffs
+    mismatched_lines = np.empty(len(order), dtype=bool)
+    mismatched_lines[order] = mismatched
+    head_lines = np.empty(len(order), dtype=bool)
+    head_lines[order] = heads
+    return changes, mismatched_lines, head_lines
 
 
 # 将出账金额置为复数，方便观看。但要注意有些冲抵金额本身为负，
-# 应用本函数后变为正数，所以自动化计算需要结合收付标志处理
+# 应用本函数后变为正数，所以自动化计算需要结合收付标志处理。
+# 根据余额推断时，按余额增减设定金额的符号（解析时已带符号的金额不会被反转），
+# 余额变化与金额不符的行在收支存疑列中标出；首笔交易无法推断，保留原符号。
+# 返回(方向存疑的行数, 保留原符号的首笔交易行数)
 def amount_set_minus(trans: pd.DataFrame,
-                     second_amount_col: str = None) -> None:
+                     second_amount_col: str = None) -> (int, int):
     if '借贷标志' in trans.columns:
         charge_off_lines = trans['借贷标志'].str.strip().isin(st.CHARGE_OFF_WORDS)
         trans.loc[charge_off_lines, '交易金额'] *= -1
@@ -37,8 +208,15 @@ def amount_set_minus(trans: pd.DataFrame,
         none_or_zero_lines = get_none_or_zero_lines(trans[second_amount_col])
         trans.loc[none_or_zero_lines, '交易金额'] *= -1
     elif '账户余额' in trans.columns:
-        less_balance_lines = pd.to_numeric(trans['账户余额']).diff() < 0
-        trans.loc[less_balance_lines, '交易金额'] *= -1
+        changes, mismatched_lines, head_lines = get_balance_changes(trans)
+        abs_amounts = trans['交易金额'].abs()
+        trans.loc[changes < 0, '交易金额'] = -abs_amounts[changes < 0]
+        trans.loc[changes > 0, '交易金额'] = abs_amounts[changes > 0]
+        if mismatched_lines.any():
+            trans['收支存疑'] = np.where(mismatched_lines, '余额变化与金额不符', None)
+        return int(mismatched_lines.sum()), int(
+            (head_lines & (abs_amounts != 0).to_numpy()).sum())
+    return 0, 0
 
 
 def get_account_name(name: str, deco_strings: Union[str, List[str]]) -> str:
@@ -62,12 +240,42 @@ def get_header(excel_file: pd.ExcelFile, sheet: str, test_header: int) -> int:
     return -2
 
 
+# 记录流水来源：工作表名，以及数据首行在工作表中的行号（从1开始）
+def mark_source(trans_sheet: pd.DataFrame, sheet: str, first_row: int) -> None:
+    trans_sheet.attrs['源工作表'] = sheet
+    trans_sheet.attrs['源行号'] = first_row
+
+
+# 在本次运行的来源登记表中查找名称对应的编码，没有则新增
+def get_source_code(sources: dict, col: str, name: str) -> int:
+    return sources[col].setdefault(name, len(sources[col]))
+
+
 # 在入账出账单独成列时，将第二列合并到第一列
 def combine_amount_cols(data: pd.DataFrame, second_amount_col: str) -> None:
     none_or_zero_lines = get_none_or_zero_lines(data['交易金额'])
     data.loc[none_or_zero_lines, '交易金额'] = data[second_amount_col]
 
 
+# 将同一账号对应的多个卡号按出现顺序合并为“卡号1/卡号2”，返回以账号为索引的查找表
+def join_cards_by_account(accounts: pd.Series, cards: pd.Series) -> pd.Series:
+    # 与groupby一致，忽略账号为空的行，也避免字符串与nan无法比较排序
+    valid = accounts.notna().to_numpy()
+    accounts = accounts.to_numpy(dtype=object)[valid]
+    order = np.argsort(accounts, kind='stable')
+    accounts = accounts[order]
+    cards = cards.to_numpy(dtype=object)[valid][order]
+    if len(accounts) == 0:
+        return pd.Series(cards, index=accounts, dtype=object)
+    starts = np.flatnonzero(
+        np.concatenate(([True], accounts[1:] != accounts[:-1])))
+    seps = np.full(len(cards), '/', dtype=object)
+    seps[starts] = ''
+    return pd.Series(np.add.reduceat(seps + cards, starts),
+                     index=accounts[starts],
+                     dtype=object)
+
+
 # 以下是特殊解析方法
 # 中国银行
 def parse_trans_boc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
@@ -111,24 +319,22 @@ def parse_trans_boc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
             new_line_accs_no_na = new_line_accs.dropna(axis=0,
                                                        how='any',
                                                        subset=['卡号'])
-            # 存在同一账号对应多个卡号的情况，将其合并到一行
-            new_line_accs_no_na_group = new_line_accs_no_na.groupby(
-                ['姓名', '子账号'])['卡号'].apply('/'.join).reset_index()
+            # 存在同一账号对应多个卡号的情况，将其合并为一项
+            new_line_cards = join_cards_by_account(new_line_accs_no_na['子账号'],
+                                                   new_line_accs_no_na['卡号'])
         else:
             format_error('本文件不包含新线账号')
         new_line_trans = excel_file.parse(sheet_name='新线交易', dtype=str)
         tmp_line_num += len(new_line_trans)
-        new_line_trans = pd.merge(new_line_trans,
-                                  new_line_accs_no_na_group[['卡号', '子账号']],
-                                  how='left',
-                                  on='子账号',
-                                  validate='m:1')
+        new_line_trans['卡号'] = new_line_trans['子账号'].map(new_line_cards)
         new_line_trans.rename(columns=col_map, inplace=True)
+        mark_source(new_line_trans, '新线交易', 2)
         tmp_trans_list_by_sheet.append(new_line_trans)
     elif '新线流水' in excel_file.sheet_names:
         new_line_trans = excel_file.parse(sheet_name='新线流水', dtype=str)
         tmp_line_num += len(new_line_trans)
         new_line_trans.rename(columns=col_map, inplace=True)
+        mark_source(new_line_trans, '新线流水', 2)
         tmp_trans_list_by_sheet.append(new_line_trans)
     else:
         format_error('本文件不包含新线交易或新线流水')
@@ -150,18 +356,15 @@ def parse_trans_boc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
             format_error('本文件不包含旧线账号或旧账号')
         old_line_accs.dropna(axis=0, how='any', subset=['卡号'], inplace=True)
         old_line_accs.drop_duplicates(inplace=True)
-        old_line_accs = old_line_accs.groupby('账号')['卡号'].apply(
-            '/'.join).reset_index()
+        old_line_cards = join_cards_by_account(old_line_accs['账号'],
+                                               old_line_accs['卡号'])
         old_line_trans = excel_file.parse(sheet_name='旧线交易',
                                           usecols='A:M',
                                           dtype=str)
         tmp_line_num += len(old_line_trans)
-        old_line_trans = pd.merge(old_line_trans,
-                                  old_line_accs,
-                                  how='left',
-                                  on='账号',
-                                  validate='m:1')
+        old_line_trans['卡号'] = old_line_trans['账号'].map(old_line_cards)
         old_line_trans.rename(columns=col_map, inplace=True)
+        mark_source(old_line_trans, '旧线交易', 2)
         tmp_trans_list_by_sheet.append(old_line_trans)
     else:
         format_error('本文件不包含旧线交易')
@@ -174,16 +377,11 @@ def parse_trans_boc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
         tmp_line_num += len(newer_trans)
         if pd.isna(newer_trans.loc[0, '姓名']):
             del newer_trans['姓名']
-            new_line_accs_name = new_line_accs[['姓名',
-                                                '子账号']].rename(columns={
-                                                    '子账号': '交易账号'
-                                                }).drop_duplicates()
-            newer_trans = pd.merge(newer_trans,
-                                   new_line_accs_name,
-                                   how='left',
-                                   on='交易账号',
-                                   validate='m:1')
+            new_line_names = new_line_accs.drop_duplicates(
+                subset=['子账号']).set_index('子账号')['姓名']
+            newer_trans['姓名'] = newer_trans['交易账号'].map(new_line_names)
         newer_trans.rename(columns=col_map, inplace=True)
+        mark_source(newer_trans, '20150701后交易', 2)
         tmp_trans_list_by_sheet.append(newer_trans)
     elif '20120720后交易流水' in excel_file.sheet_names:
         newer_trans = excel_file.parse(sheet_name='20120720后交易流水',
@@ -191,6 +389,7 @@ def parse_trans_boc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
                                        dtype=str)
         tmp_line_num += len(newer_trans)
         newer_trans.rename(columns=col_map, inplace=True)
+        mark_source(newer_trans, '20120720后交易流水', 2)
         tmp_trans_list_by_sheet.append(newer_trans)
     else:
         format_error('本文件不包含20120720后交易流水')
@@ -203,7 +402,7 @@ def parse_trans_boc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
 
 # 建设银行
 def parse_trans_ccb(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
-    def _parse_sheet(row_data, header, trans_list_by_sheet):
+    def _parse_sheet(row_data, header, sheet, trans_list_by_sheet):
         header_lines = row_data.index[row_data.duplicated()].to_list()
         header_lines.append(len(row_data) + 1)
         _begin = 2
@@ -219,6 +418,7 @@ def parse_trans_ccb(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
                 tmp_trans['币种'] = tmp_acc[9]
             if tmp_trans.iloc[0, 0] != '查无结果':
                 line_num += len(tmp_trans)
+            mark_source(tmp_trans, sheet, 9)  # 跳过了8行，行索引0即第9行
             trans_list_by_sheet.append(tmp_trans)
             _begin = _end + 1
         return line_num
@@ -243,64 +443,132 @@ def parse_trans_ccb(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
         current_deposit_str = '企业活期明细信息'
         fixed_deposit_str = '企业定期明细信息'
 
-    # 分析活期流水
-    header1 = excel_file.parse(sheet_name=current_deposit_str,
-                               header=9,
-                               nrows=0)
-    header1.rename(columns=col_map, inplace=True)
-    row_data1 = excel_file.parse(sheet_name=current_deposit_str,
-                                 header=None,
-                                 skiprows=8,
-                                 dtype=str)
-    first_amount_col = pd.to_numeric(row_data1[5], errors='coerce') * -1
-    second_amount_col = pd.to_numeric(row_data1[6], errors='coerce')
-    first_amount_col[first_amount_col == 0] = second_amount_col
-    row_data1[5] = first_amount_col
-    tmp_line_num += _parse_sheet(row_data1, header1, tmp_trans_list_by_sheet)
-    # 分析定期流水
-    header2 = excel_file.parse(sheet_name=fixed_deposit_str, header=9, nrows=0)
-    header2.rename(columns=col_map, inplace=True)
-    row_data2 = excel_file.parse(sheet_name=fixed_deposit_str,
-                                 header=None,
-                                 skiprows=8,
-                                 dtype=str)
-    tmp_line_num += _parse_sheet(row_data2, header2, tmp_trans_list_by_sheet)
+    # 分析活期流水和定期流水
+    for sheet in (current_deposit_str, fixed_deposit_str):
+        header = excel_file.parse(sheet_name=sheet, header=9, nrows=0)
+        row_data = excel_file.parse(sheet_name=sheet,
+                                    header=None,
+                                    skiprows=8,
+                                    dtype=str)
+        # 借方发生额取负值，为0时取贷方发生额，合并为带符号的交易金额
+        _cols = list(header.columns)
+        if '借方发生额' in _cols and '贷方发生额' in _cols:
+            _debit, _credit = _cols.index('借方发生额'), _cols.index('贷方发生额')
+            first_amount_col = pd.to_numeric(row_data[_debit],
+                                             errors='coerce') * -1
+            second_amount_col = pd.to_numeric(row_data[_credit],
+                                              errors='coerce')
+            first_amount_col[first_amount_col == 0] = second_amount_col
+            row_data[_debit] = first_amount_col
+        header.rename(columns=col_map, inplace=True)
+        tmp_line_num += _parse_sheet(row_data, header, sheet,
+                                     tmp_trans_list_by_sheet)
+    return tmp_line_num
+
+
+# 工作簿的来源，即文件路径或预读的文件内容，供子进程重新打开
+def get_excel_source(excel_file: pd.ExcelFile) -> Union[str, bytes]:
+    if isinstance(excel_file.io, io.BytesIO):
+        return excel_file.io.getvalue()
+    return excel_file.io
+
+
+# 估算按工作表并行解析的进程数：工作表数和文件大小均达到阈值时才并行，
+# 且每个进程都要自行打开工作簿，进程数受内存预算限制
+def get_sheet_workers(excel_file: pd.ExcelFile) -> int:
+    sheet_num = len(excel_file.sheet_names)
+    if isinstance(excel_file.io, io.BytesIO):
+        file_size = excel_file.io.getbuffer().nbytes
+    elif isinstance(excel_file.io, (str, pathlib.Path)):
+        file_size = pathlib.Path(excel_file.io).stat().st_size
+    else:
+        return 1
+    if (sheet_num < st.SHEET_PARALLEL_MIN_SHEETS
+            or file_size < st.SHEET_PARALLEL_MIN_SIZE):
+        return 1
+    return max(
+        1,
+        min(st.SHEET_WORKERS, sheet_num,
+            st.SHEET_MEMORY_BUDGET // (file_size * st.SHEET_MEMORY_FACTOR)))
+
+
+# 在子进程中打开工作簿，解析其中的部分工作表
+def parse_sheets_worker(excel_source: Union[str, bytes], sheets: List[str],
+                        parse_sheet, args: tuple) -> (int, list):
+    if isinstance(excel_source, bytes):
+        excel_source = io.BytesIO(excel_source)
+    excel_file = pd.ExcelFile(excel_source)
+    tmp_trans_list_by_sheet = []
+    tmp_line_num = 0
+    for sheet in sheets:
+        tmp_line_num += parse_sheet(excel_file, sheet, tmp_trans_list_by_sheet,
+                                    *args)
+    return tmp_line_num, tmp_trans_list_by_sheet
+
+
+# 用parse_sheet逐个解析工作簿中的工作表。工作表较多的大文件按顺序分成若干组，
+# 交给多个进程并行解析，结果仍按工作表顺序合并
+def parse_sheets(excel_file: pd.ExcelFile, parse_sheet,
+                 tmp_trans_list_by_sheet, *args) -> int:
+    tmp_line_num = 0
+    workers = get_sheet_workers(excel_file)
+    if workers == 1:
+        for sheet in excel_file.sheet_names:
+            tmp_line_num += parse_sheet(excel_file, sheet,
+                                        tmp_trans_list_by_sheet, *args)
+        return tmp_line_num
+    sheet_groups = np.array_split(np.array(excel_file.sheet_names, dtype=object),
+                                  workers)
+    excel_source = get_excel_source(excel_file)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(parse_sheets_worker, excel_source, list(sheets),
+                            parse_sheet, args) for sheets in sheet_groups
+        ]
+        for future in futures:
+            _line_num, _trans_list = future.result()
+            tmp_line_num += _line_num
+            tmp_trans_list_by_sheet.extend(_trans_list)
     return tmp_line_num
 
 
 # 邮储银行
-def parse_trans_psbc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+def parse_sheet_psbc(excel_file: pd.ExcelFile, sheet: str,
+                     tmp_trans_list_by_sheet) -> int:
     col_map = {
         '交易渠道': '交易方式',
         '交易机构名称': '交易网点',
         '对方账号/卡号/汇票号': '对方账号',
         '对方开户机构': '对方开户行',
     }
-    tmp_line_num = 0
-    for sheet in excel_file.sheet_names:
-        tmp_acc_strs = excel_file.parse(sheet_name=sheet, header=None, nrows=4)
-        if len(tmp_acc_strs) == 0:
-            continue
-        _tmp_str = tmp_acc_strs.iloc[1, 0].split(':')
-        _name = _tmp_str[2]
-        _account = _tmp_str[1].split()[0]
-        _currency = tmp_acc_strs.iloc[3, 0].split(':')[1].split()[0]
-        tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
-                                           header=5,
-                                           dtype=str,
-                                           skipfooter=3)
-        tmp_trans_sheet.columns = tmp_trans_sheet.columns.str.strip()
-        tmp_trans_sheet.rename(columns=col_map, inplace=True)
-        tmp_trans_sheet['户名'] = _name
-        tmp_trans_sheet['账号'] = _account
-        tmp_trans_sheet['币种'] = _currency
-        tmp_trans_list_by_sheet.append(tmp_trans_sheet)
-        tmp_line_num += len(tmp_trans_sheet)
-    return tmp_line_num
+    tmp_acc_strs = excel_file.parse(sheet_name=sheet, header=None, nrows=4)
+    if len(tmp_acc_strs) == 0:
+        return 0
+    _tmp_str = tmp_acc_strs.iloc[1, 0].split(':')
+    _name = _tmp_str[2]
+    _account = _tmp_str[1].split()[0]
+    _currency = tmp_acc_strs.iloc[3, 0].split(':')[1].split()[0]
+    tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
+                                       header=5,
+                                       dtype=str,
+                                       skipfooter=3)
+    tmp_trans_sheet.columns = tmp_trans_sheet.columns.str.strip()
+    tmp_trans_sheet.rename(columns=col_map, inplace=True)
+    tmp_trans_sheet['户名'] = _name
+    tmp_trans_sheet['账号'] = _account
+    tmp_trans_sheet['币种'] = _currency
+    mark_source(tmp_trans_sheet, sheet, 7)
+    tmp_trans_list_by_sheet.append(tmp_trans_sheet)
+    return len(tmp_trans_sheet)
+
+
+def parse_trans_psbc(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+    return parse_sheets(excel_file, parse_sheet_psbc, tmp_trans_list_by_sheet)
 
 
 # 宁夏银行
-def parse_trans_bonx(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+def parse_sheet_bonx(excel_file: pd.ExcelFile, sheet: str,
+                     tmp_trans_list_by_sheet) -> int:
     col_map = {
         '交易机构': '交易网点',
         '交易类型': '交易方式',
@@ -308,62 +576,69 @@ def parse_trans_bonx(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
         '对方行名': '对方开户行',
         '对方名称': '对方户名',
     }
-    tmp_line_num = 0
-    for sheet in excel_file.sheet_names:
-        tmp_acc_strs = excel_file.parse(sheet_name=sheet, header=None, nrows=4)
-        if len(tmp_acc_strs) == 0:
-            continue
-        _name = tmp_acc_strs.iloc[1, 0].split('：')[1]
-        _account = tmp_acc_strs.iloc[2, 0].split('：')[1]
-        _card = tmp_acc_strs.iloc[3, 0].split('：')[1]
-        tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
-                                           header=6,
-                                           dtype=str)
-        tmp_trans_sheet.columns = tmp_trans_sheet.columns.str.strip()
-        tmp_trans_sheet.rename(columns=col_map, inplace=True)
-        tmp_trans_sheet['户名'] = _name
-        tmp_trans_sheet['账号'] = _account
-        tmp_trans_sheet['卡号'] = _card
-        tmp_trans_list_by_sheet.append(tmp_trans_sheet)
-        tmp_line_num += len(tmp_trans_sheet)
-    return tmp_line_num
+    tmp_acc_strs = excel_file.parse(sheet_name=sheet, header=None, nrows=4)
+    if len(tmp_acc_strs) == 0:
+        return 0
+    _name = tmp_acc_strs.iloc[1, 0].split('：')[1]
+    _account = tmp_acc_strs.iloc[2, 0].split('：')[1]
+    _card = tmp_acc_strs.iloc[3, 0].split('：')[1]
+    tmp_trans_sheet = excel_file.parse(sheet_name=sheet, header=6, dtype=str)
+    tmp_trans_sheet.columns = tmp_trans_sheet.columns.str.strip()
+    tmp_trans_sheet.rename(columns=col_map, inplace=True)
+    tmp_trans_sheet['户名'] = _name
+    tmp_trans_sheet['账号'] = _account
+    tmp_trans_sheet['卡号'] = _card
+    mark_source(tmp_trans_sheet, sheet, 8)
+    tmp_trans_list_by_sheet.append(tmp_trans_sheet)
+    return len(tmp_trans_sheet)
+
+
+def parse_trans_bonx(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+    return parse_sheets(excel_file, parse_sheet_bonx, tmp_trans_list_by_sheet)
 
 
 # 平安银行
-def parse_trans_pab(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+def parse_sheet_pab(excel_file: pd.ExcelFile, sheet: str,
+                    tmp_trans_list_by_sheet) -> int:
     col_map = {
         '借方发生额': '交易金额',
         '交易对方户名': '对方户名',
         '交易对方账号': '对方账号',
         '交易对方行名称': '对方开户行',
     }
-    tmp_line_num = 0
-    for sheet in excel_file.sheet_names:
-        tmp_acc_strs = excel_file.parse(sheet_name=sheet, header=None, nrows=5)
-        tmp_acc_strs.dropna(how='all', axis=1, inplace=True)
-        _name = tmp_acc_strs.iloc[1, 3]
-        _account = tmp_acc_strs.iloc[1, 1]
-        _card_num = tmp_acc_strs.iloc[2, 1]
-        _currency = tmp_acc_strs.iloc[4, 3]
-        tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
-                                           header=6,
-                                           dtype=str,
-                                           skipfooter=2)
-        tmp_trans_sheet.rename(columns=col_map, inplace=True)
-        tmp_trans_sheet['户名'] = _name
-        tmp_trans_sheet['账号'] = _account
-        tmp_trans_sheet['卡号'] = _card_num
-        tmp_trans_sheet['币种'] = _currency
-        tmp_trans_sheet['交易金额'] = tmp_trans_sheet['交易金额'].str.replace(',', '')
-        tmp_trans_sheet['贷方发生额'] = tmp_trans_sheet['贷方发生额'].str.replace(
-            ',', '')
-        tmp_trans_list_by_sheet.append(tmp_trans_sheet)
-        tmp_line_num += len(tmp_trans_sheet)
-    return tmp_line_num
+    # 账号、卡号可能存为数字单元格，按文本读取以免变为浮点数
+    tmp_acc_strs = excel_file.parse(sheet_name=sheet,
+                                    header=None,
+                                    nrows=5,
+                                    dtype=str)
+    tmp_acc_strs.dropna(how='all', axis=1, inplace=True)
+    _name = tmp_acc_strs.iloc[1, 3]
+    _account = tmp_acc_strs.iloc[1, 1]
+    _card_num = tmp_acc_strs.iloc[2, 1]
+    _currency = tmp_acc_strs.iloc[4, 3]
+    tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
+                                       header=6,
+                                       dtype=str,
+                                       skipfooter=2)
+    tmp_trans_sheet.rename(columns=col_map, inplace=True)
+    tmp_trans_sheet['户名'] = _name
+    tmp_trans_sheet['账号'] = _account
+    tmp_trans_sheet['卡号'] = _card_num
+    tmp_trans_sheet['币种'] = _currency
+    tmp_trans_sheet['交易金额'] = tmp_trans_sheet['交易金额'].str.replace(',', '')
+    tmp_trans_sheet['贷方发生额'] = tmp_trans_sheet['贷方发生额'].str.replace(',', '')
+    mark_source(tmp_trans_sheet, sheet, 8)
+    tmp_trans_list_by_sheet.append(tmp_trans_sheet)
+    return len(tmp_trans_sheet)
+
+
+def parse_trans_pab(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+    return parse_sheets(excel_file, parse_sheet_pab, tmp_trans_list_by_sheet)
 
 
 # 华夏银行
-def parse_trans_hxb(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+def parse_sheet_hxb(excel_file: pd.ExcelFile, sheet: str,
+                    tmp_trans_list_by_sheet) -> int:
     col_map = {
         '客户名称': '户名',
         '过账日期': '交易日期',
@@ -375,83 +650,96 @@ def parse_trans_hxb(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
         '对方账号(或商户编号)': '对方账号',
         '对方银行': '对方开户行'
     }
-    tmp_line_num = 0
-    for sheet in excel_file.sheet_names:
-        header = get_header(excel_file, sheet, st.TEST_HEADER)  # 寻找表头
-        if header == 0:
-            tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
-                                               header=header,
-                                               dtype=str)
-            tmp_trans_sheet.rename(columns=col_map, inplace=True)
-        elif header == 2:
-            tmp_acc_strs = excel_file.parse(sheet_name=sheet,
-                                            header=None,
-                                            nrows=2)
-            _tmp_str = tmp_acc_strs.iloc[1, 0].split('：')
-            _name = _tmp_str[4]
-            _account = _tmp_str[1].split()[0]
-            _card_num = _tmp_str[3].split()[0]
-            tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
-                                               header=2,
-                                               dtype=str)
-            tmp_trans_sheet.rename(columns=col_map, inplace=True)
-            tmp_trans_sheet['户名'] = _name
-            tmp_trans_sheet['账号'] = _account
-            tmp_trans_sheet['卡号'] = _card_num
-        elif header == -1:
-            continue
-        else:
-            format_error('{}无法解析，跳过'.format(sheet))
-            continue
-        tmp_trans_list_by_sheet.append(tmp_trans_sheet)
-        tmp_line_num += len(tmp_trans_sheet)
-    return tmp_line_num
+    header = get_header(excel_file, sheet, st.TEST_HEADER)  # 寻找表头
+    if header == 0:
+        tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
+                                           header=header,
+                                           dtype=str)
+        tmp_trans_sheet.rename(columns=col_map, inplace=True)
+    elif header == 2:
+        tmp_acc_strs = excel_file.parse(sheet_name=sheet, header=None, nrows=2)
+        _tmp_str = tmp_acc_strs.iloc[1, 0].split('：')
+        _name = _tmp_str[4]
+        _account = _tmp_str[1].split()[0]
+        _card_num = _tmp_str[3].split()[0]
+        tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
+                                           header=2,
+                                           dtype=str)
+        tmp_trans_sheet.rename(columns=col_map, inplace=True)
+        tmp_trans_sheet['户名'] = _name
+        tmp_trans_sheet['账号'] = _account
+        tmp_trans_sheet['卡号'] = _card_num
+    elif header == -1:
+        return 0
+    else:
+        format_error('{}无法解析，跳过'.format(sheet))
+        return 0
+    mark_source(tmp_trans_sheet, sheet, header + 2)
+    tmp_trans_list_by_sheet.append(tmp_trans_sheet)
+    return len(tmp_trans_sheet)
+
+
+def parse_trans_hxb(excel_file: pd.ExcelFile, tmp_trans_list_by_sheet) -> int:
+    return parse_sheets(excel_file, parse_sheet_hxb, tmp_trans_list_by_sheet)
 
 
 # 一般银行分析
+def parse_sheet_common(excel_file: pd.ExcelFile, sheet: str,
+                       tmp_trans_list_by_sheet, bank_para: st.BankPara) -> int:
+    header = get_header(excel_file, sheet, st.TEST_HEADER)  # 寻找表头
+    if header == -1:  # 空工作表
+        return 0
+    elif header == -2:  # 含数据但表头超过测试数而无法解析的工作表
+        format_error('{}无法解析，跳过'.format(sheet))
+        return 0
+    # 找到表头
+    tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
+                                       header=header,
+                                       dtype=str)
+    if len(tmp_trans_sheet) == 0:
+        return 0
+    tmp_trans_sheet.rename(columns=bank_para.col_map, inplace=True)
+    # 识别非流水表和空数据表
+    if '交易日期' not in tmp_trans_sheet.columns:
+        if not bank_para.has_nodata_sheets:
+            format_error('{}不包含交易日期，跳过'.format(sheet))
+        return 0
+    if tmp_trans_sheet['交易日期'].isna().all():
+        if not bank_para.has_empty_sheets:
+            format_error('{}交易日期不完整，跳过'.format(sheet))
+        return 0
+    # 如果本文件名符合如下规则, 此时认为工作表名就是户名
+    if bank_para.sheet_name_is == '户名':
+        tmp_trans_sheet['户名'] = sheet
+    elif bank_para.sheet_name_is == '账号':
+        tmp_trans_sheet['账号'] = sheet
+    mark_source(tmp_trans_sheet, sheet, header + 2)
+    tmp_trans_list_by_sheet.append(tmp_trans_sheet)
+    if tmp_trans_sheet.iloc[0, 0] not in st.NONE_TRANS_WORDS:
+        return len(tmp_trans_sheet)
+    return 0
+
+
 def parse_trans_common(excel_file: pd.ExcelFile, bank_para: st.BankPara,
                        tmp_trans_list_by_sheet) -> int:
-    tmp_line_num = 0
-    for sheet in excel_file.sheet_names:  # 对每一个工作表
-        header = get_header(excel_file, sheet, st.TEST_HEADER)  # 寻找表头
-        if header == -1:  # 空工作表
-            continue
-        elif header == -2:  # 含数据但表头超过测试数而无法解析的工作表
-            format_error('{}无法解析，跳过'.format(sheet))
-            continue
-        else:  # 找到表头
-            tmp_trans_sheet = excel_file.parse(sheet_name=sheet,
-                                               header=header,
-                                               dtype=str)
-            if len(tmp_trans_sheet) == 0:
-                continue
-            tmp_trans_sheet.rename(columns=bank_para.col_map, inplace=True)
-            # 识别非流水表和空数据表
-            if '交易日期' not in tmp_trans_sheet.columns:
-                if not bank_para.has_nodata_sheets:
-                    format_error('{}不包含交易日期，跳过'.format(sheet))
-                continue
-            if tmp_trans_sheet['交易日期'].isna().all():
-                if not bank_para.has_empty_sheets:
-                    format_error('{}交易日期不完整，跳过'.format(sheet))
-                continue
-            # 如果本文件名符合如下规则, 此时认为工作表名就是户名
-            if bank_para.sheet_name_is == '户名':
-                tmp_trans_sheet['户名'] = sheet
-            elif bank_para.sheet_name_is == '账号':
-                tmp_trans_sheet['账号'] = sheet
-            tmp_trans_list_by_sheet.append(tmp_trans_sheet)
-            if tmp_trans_sheet.iloc[0, 0] not in st.NONE_TRANS_WORDS:
-                tmp_line_num += len(tmp_trans_sheet)
-            continue
-    return tmp_line_num
+    return parse_sheets(excel_file, parse_sheet_common, tmp_trans_list_by_sheet,
+                        bank_para)
 
 
-# 解析流水文件，将结果保存在tmp_trans_list_by_file中，并返回总行数
-def parse_trans_file(trans_file: pathlib.Path, bank_para: st.BankPara,
-                     tmp_trans_list_by_file: list) -> int:
+# 解析流水文件，将结果保存在tmp_trans_list_by_file中，并返回总行数。
+# sources为来源登记表时，为流水添加源文件、源工作表编码和源行号；
+# file_data为预读的文件内容，为None时从磁盘读取；trans_filter为筛选条件
+def parse_trans_file(trans_file: pathlib.Path,
+                     bank_para: st.BankPara,
+                     tmp_trans_list_by_file: list,
+                     sources: dict = None,
+                     file_data: bytes = None,
+                     trans_filter: TransFilter = None) -> int:
     format_progress('    {}……'.format(trans_file.name), True)
-    excel_file = pd.ExcelFile(trans_file)
+    if file_data is None:
+        excel_file = pd.ExcelFile(trans_file)
+    else:
+        excel_file = pd.ExcelFile(io.BytesIO(file_data))
     tmp_trans_list_by_sheet = []  # 当前文件流水列表（按工作表）
     tmp_line_num = 0  # 当前文件流水行数
     if bank_para.special_func == '中国银行':
@@ -469,10 +757,33 @@ def parse_trans_file(trans_file: pathlib.Path, bank_para: st.BankPara,
     else:  # 其他银行
         tmp_line_num = parse_trans_common(excel_file, bank_para,
                                           tmp_trans_list_by_sheet)
+    if sources is not None:
+        for _df in tmp_trans_list_by_sheet:
+            _df['源工作表'] = np.full(len(_df),
+                                 get_source_code(sources, '源工作表',
+                                                 _df.attrs.get('源工作表', '')),
+                                 dtype=np.int32)
+            _df['源行号'] = (_df.index.to_numpy() +
+                          _df.attrs.get('源行号', 0)).astype(np.int32)
+    # 需根据余额推断收支方向时不在此筛选：剔除任何一行都会使下一行失去余额差，
+    # 而同一账户的相邻流水可能分布在不同文件中，筛选推迟到推断收支方向之后
+    if trans_filter is not None:
+        for i, _df in enumerate(tmp_trans_list_by_sheet):
+            if not (bank_para.has_minus_amounts or '借贷标志' in _df.columns
+                    or bank_para.second_amount_col in _df.columns):
+                continue
+            tmp_trans_list_by_sheet[i] = trans_filter.apply_to_sheet(_df)
+            tmp_line_num -= len(_df) - len(tmp_trans_list_by_sheet[i])
+        tmp_line_num = max(tmp_line_num, 0)
     try:
         tmp_transactions = pd.concat(tmp_trans_list_by_sheet,
                                      ignore_index=True,
                                      sort=False)
+        if sources is not None:
+            tmp_transactions['源文件'] = np.full(
+                len(tmp_transactions),
+                get_source_code(sources, '源文件', str(trans_file)),
+                dtype=np.int32)
         if bank_para.second_amount_col is not None:
             combine_amount_cols(tmp_transactions, bank_para.second_amount_col)
         tmp_transactions.dropna(axis=0, subset=['交易日期', '交易金额'], inplace=True)
@@ -487,6 +798,19 @@ def parse_trans_file(trans_file: pathlib.Path, bank_para: st.BankPara,
                 tmp_name = trans_file.stem
             tmp_transactions['户名'] = get_account_name(tmp_name,
                                                       bank_para.deco_strings)
+        # 按交易日期稳定排序，流水大多已按时间排列，代价很小；
+        # 各文件有序后，最终合并只需归并有序段
+        tmp_transactions['交易日期'] = pd.to_datetime(tmp_transactions['交易日期'],
+                                                  errors='coerce')
+        tmp_transactions.sort_values(by='交易日期', kind='stable', inplace=True)
+        # 各工作表已按日期、账号和户名预筛，此处补充金额条件和由文件名补全的户名
+        if trans_filter is not None and (
+                bank_para.has_minus_amounts or
+                '借贷标志' in tmp_transactions.columns or
+                bank_para.second_amount_col in tmp_transactions.columns):
+            _line_num = len(tmp_transactions)
+            tmp_transactions = trans_filter.apply(tmp_transactions)
+            tmp_line_num -= _line_num - len(tmp_transactions)
         tmp_trans_list_by_file.append(tmp_transactions)
         if (tmp_line_num -
                 len(tmp_transactions)) == (bank_para.footer *
@@ -504,17 +828,232 @@ def parse_trans_file(trans_file: pathlib.Path, bank_para: st.BankPara,
     return tmp_line_num
 
 
+# 对规范化后的关键字段计算64位哈希，去除已在其他文件中出现过的交易。同一文件内的相同交易
+# 视为真实交易予以保留。返回去重后的流水和重叠文件统计{(先出现的文件, 重复的文件): 行数}
+def drop_duplicate_trans(trans: pd.DataFrame, file_codes: np.ndarray,
+                         file_names: List[str]) -> (pd.DataFrame, pd.Series):
+    keys = trans.reindex(columns=st.DUPLICATE_KEY_COLS)
+    keys['账号'] = keys['账号'].fillna(keys['卡号'])
+    del keys['卡号']
+    for col in keys.columns:
+        if col == '交易日期':
+            continue
+        elif col in ('交易金额', '账户余额'):
+            keys[col] = np.round(get_yuan_array(keys[col]), 2)
+        elif col == '币种':  # 不同文件中币种写法可能不同
+            keys[col] = np.asarray(normalize_currency(keys[col]), dtype=object)
+        else:  # 忽略空白字符的差异
+            keys[col] = keys[col].fillna('').astype(str).str.replace(
+                r'\s+', '', regex=True)
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+    codes, uniques = pd.factorize(hashes)
+    first_files = np.empty(len(uniques), dtype=file_codes.dtype)
+    first_files[codes[::-1]] = file_codes[::-1]  # 倒序赋值，保留每个哈希最先出现的文件
+    first_files = first_files[codes]
+    dup_lines = file_codes != first_files
+    file_names = np.asarray(file_names, dtype=object)
+    overlaps = pd.Series(
+        list(zip(file_names[first_files[dup_lines]],
+                 file_names[file_codes[dup_lines]])),
+        dtype=object).value_counts()
+    return trans[~dup_lines], overlaps
+
+
+# 受监控解析的子进程：解析文件后将流水、行数和新增的来源编码放入结果队列
+def parse_file_worker(results: multiprocessing.Queue, trans_file: pathlib.Path,
+                      bank_para: st.BankPara, sources: dict, file_data: bytes,
+                      trans_filter: TransFilter) -> None:
+    # 不再按工作表启动孙进程：孙进程的内存不计入监控，终止子进程时也会成为孤儿进程
+    st.SHEET_WORKERS = 1
+    try:
+        tmp_trans_list_by_file = []
+        line_num = parse_trans_file(trans_file, bank_para,
+                                    tmp_trans_list_by_file, sources,
+                                    file_data, trans_filter)
+        results.put((line_num, tmp_trans_list_by_file, sources, None))
+    except Exception as e:
+        results.put((0, [], sources, repr(e)))
+    sys.stdout.flush()
+
+
+_rss_warned = False  # 是否已提示内存上限不生效
+
+
+# 进程的常驻内存（字节）。优先读取/proc，没有/proc的系统使用psutil，
+# 两者均不可用时返回0（内存上限不生效），并提示一次
+def get_process_rss(pid: int) -> int:
+    global _rss_warned
+    if os.path.exists('/proc/self/statm'):
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):  # 进程已退出
+            return 0
+    if importlib.util.find_spec('psutil') is not None:
+        psutil = importlib.import_module('psutil')
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return 0
+    if not _rss_warned:
+        _rss_warned = True
+        format_progress('✘无法读取进程内存（没有/proc且未安装psutil），文件解析的内存上限不生效')
+    return 0
+
+
+
+# 在子进程中解析流水文件，超时或新增常驻内存超过上限时终止子进程。子进程由fork创建时
+# 与父进程共享的内存也计入其常驻内存，因此以父进程当前的常驻内存为基准
+# 成功时结果追加到tmp_trans_list_by_file、来源编码合并到sources，返回(总行数, None)；
+# 失败时返回(0, 原因)
+def parse_trans_file_supervised(trans_file: pathlib.Path,
+                                bank_para: st.BankPara,
+                                tmp_trans_list_by_file: list,
+                                sources: dict = None,
+                                file_data: bytes = None,
+                                trans_filter: TransFilter = None) -> (int, str):
+    context = multiprocessing.get_context(
+        'fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    results = context.Queue()
+    worker = context.Process(target=parse_file_worker,
+                             args=(results, trans_file, bank_para, sources,
+                                   file_data, trans_filter))
+    sys.stdout.flush()
+    base_rss = get_process_rss(os.getpid())
+    worker.start()
+    start = time.perf_counter()
+    reason = None
+    while True:
+        try:
+            line_num, trans_list, worker_sources, reason = results.get(
+                timeout=st.FILE_POLL_INTERVAL)
+            break
+        except queue.Empty:
+            pass
+        if not worker.is_alive():
+            if worker.exitcode == 0:
+                # 子进程已放入结果后正常退出，结果可能尚未到达队列，再等待一次
+                try:
+                    line_num, trans_list, worker_sources, reason = results.get(
+                        timeout=st.FILE_RESULT_WAIT)
+                    break
+                except queue.Empty:
+                    pass
+            reason = '子进程异常退出（退出码{}）'.format(worker.exitcode)
+        elif time.perf_counter() - start > st.FILE_TIMEOUT:
+            reason = '解析超时（{}秒）'.format(st.FILE_TIMEOUT)
+        elif get_process_rss(worker.pid) - base_rss > st.FILE_MEMORY_LIMIT:
+            reason = '内存超限（{}MB）'.format(st.FILE_MEMORY_LIMIT // 1024**2)
+        if reason is not None:
+            worker.kill()
+            worker.join()
+            return 0, reason
+    worker.join()
+    if reason is not None:
+        return 0, reason
+    tmp_trans_list_by_file.extend(trans_list)
+    if sources is not None:
+        for col, names in worker_sources.items():
+            sources[col].update(names)
+    return line_num, None
+
+
+# 输出被隔离的文件及原因
+def print_quarantined(dir_path: pathlib.Path, tmp_quarantined: list) -> None:
+    if len(tmp_quarantined) == 0:
+        return
+    format_progress('    ✘隔离无法解析的文件{}个：'.format(len(tmp_quarantined)))
+    for _file in tmp_quarantined:
+        format_progress('      【{}】{}'.format(
+            pathlib.Path(_file['文件']).relative_to(dir_path), _file['原因']))
+
+
+# 后台线程预读文件内容，使磁盘或网络读取与解析重叠。依次返回(文件路径, 文件内容)，
+# 预读文件数不超过PREFETCH_DEPTH，已读未解析的内容不超过PREFETCH_MEMORY，
+# 超过内存上限的大文件不预读，返回的内容为None
+def prefetch_files(trans_files: List[pathlib.Path]):
+    sizes = [trans_file.stat().st_size for trans_file in trans_files]
+    pending = collections.deque()  # 已提交的预读任务(任务, 占用内存)
+    buffered = 0  # 已提交预读但尚未解析完的字节数
+    next_file = 0
+    with ThreadPoolExecutor(max_workers=st.PREFETCH_THREADS) as executor:
+        for trans_file in trans_files:
+            while (next_file < len(trans_files)
+                   and len(pending) < st.PREFETCH_DEPTH):
+                size = sizes[next_file]
+                if size > st.PREFETCH_MEMORY:
+                    pending.append((None, 0))
+                elif buffered + size <= st.PREFETCH_MEMORY:
+                    pending.append((executor.submit(
+                        trans_files[next_file].read_bytes), size))
+                    buffered += size
+                else:  # 等当前文件解析完释放内存后再预读
+                    break
+                next_file += 1
+            future, size = pending.popleft()
+            yield trans_file, None if future is None else future.result()
+            buffered -= size
+
+
+# 读取工作簿前几个工作表的前几行，返回工作表名和单元格文字组成的特征集合，不解析表体
+def get_excel_tokens(trans_file: pathlib.Path) -> set:
+    excel_file = pd.ExcelFile(trans_file)
+    tokens = set(excel_file.sheet_names)
+    for sheet in excel_file.sheet_names[:st.DETECT_SHEETS]:
+        cells = excel_file.parse(sheet_name=sheet,
+                                 header=None,
+                                 nrows=st.DETECT_ROWS,
+                                 dtype=str).to_numpy().ravel()
+        tokens.update(_cell.strip() for _cell in cells if isinstance(_cell, str))
+    return tokens
+
+
+# 根据目录中抽样文件的表头识别银行：在倒排索引中查找各特征对应的银行并累加权重，
+# 返回得分唯一最高且命中特征不少于DETECT_MIN_TOKENS个的银行名称，无法识别时返回None
+def detect_bank(dir_path: pathlib.Path) -> str:
+    trans_files = sorted(
+        _file for _file in dir_path.rglob('*')
+        if _file.is_file() and not _file.match('~*'))[:st.DETECT_FILES]
+    tokens = set()
+    for trans_file in trans_files:
+        try:
+            tokens |= get_excel_tokens(trans_file)
+        except Exception:  # 无法读取的文件不参与识别
+            continue
+    scores = collections.Counter()
+    hits = collections.Counter()
+    for token in tokens & st.BANK_INDEX.keys():
+        for name, weight in st.BANK_INDEX[token].items():
+            scores[name] += weight
+            hits[name] += 1
+    ranks = scores.most_common(2)
+    if len(ranks) == 0 or hits[ranks[0][0]] < st.DETECT_MIN_TOKENS or (
+            len(ranks) == 2 and ranks[0][1] == ranks[1][1]):
+        return None
+    return ranks[0][0]
+
+
+# bank_name为流水的银行名称，为None时使用目录名；
+# fen为True时交易金额和账户余额解析为以分为单位的整数；
+# supervise为True时每个文件在受监控的子进程中解析，失败的文件单独重试，
+# 仍失败的以{'银行', '文件', '原因'}追加到quarantined中
 def parse_base_dir(dir_path: pathlib.Path,
-                   bank_para: st.BankPara) -> (pd.DataFrame, bool):
+                   bank_para: st.BankPara,
+                   dedup: bool = True,
+                   sources: dict = None,
+                   trans_filter: TransFilter = None,
+                   bank_name: str = None,
+                   fen: bool = False,
+                   supervise: bool = False,
+                   quarantined: list = None) -> (pd.DataFrame, bool):
     format_progress('开始分析{}账户……'.format(dir_path.name))
     tmp_trans_list_by_file = []  # 流水列表（按文件）
+    tmp_file_names = []  # 与流水列表对应的文件名
     tmp_all_nums = 0  # 所有流水行数
+    trans_files = []  # 待解析的文件
     for trans_file in dir_path.iterdir():
         if trans_file.is_dir():  # 对每一个子目录
-            format_progress('  进入子目录——{}……'.format(trans_file.name))
-            for sub_file in trans_file.iterdir():  # 解析子目录所有文件
-                tmp_all_nums += parse_trans_file(sub_file, bank_para,
-                                                 tmp_trans_list_by_file)
+            trans_files.extend(trans_file.iterdir())  # 解析子目录所有文件
         else:  # 对每一个文件
             if trans_file.match('~*') or trans_file.match(dir_path.name +
                                                           '账户*'):
@@ -523,17 +1062,92 @@ def parse_base_dir(dir_path: pathlib.Path,
                 format_progress('    【{}】暂不支持，跳过'.format(trans_file.name))
                 continue
             else:
-                tmp_all_nums += parse_trans_file(trans_file, bank_para,
-                                                 tmp_trans_list_by_file)
+                trans_files.append(trans_file)
+    failed_files = {}  # 受监控解析失败的文件及原因
+    tmp_quarantined = []  # 重试后仍失败的文件
+    _sub_dir = dir_path
+    for trans_file, file_data in prefetch_files(trans_files):
+        # 子目录的文件与其后的文件连续解析，父目录变化时提示，避免误认为仍在子目录中
+        if trans_file.parent != _sub_dir:
+            if _sub_dir != dir_path:
+                format_progress('  离开子目录——{}'.format(_sub_dir.name))
+            _sub_dir = trans_file.parent
+            if _sub_dir != dir_path:
+                format_progress('  进入子目录——{}……'.format(_sub_dir.name))
+        if supervise:
+            _line_num, _reason = parse_trans_file_supervised(
+                trans_file, bank_para, tmp_trans_list_by_file, sources,
+                file_data, trans_filter)
+            if _reason is not None:
+                format_error('{}解析失败（{}），稍后单独重试'.format(
+                    trans_file.name, _reason))
+                format_progress('')
+                failed_files[trans_file] = _reason
+            tmp_all_nums += _line_num
+        else:
+            tmp_all_nums += parse_trans_file(trans_file, bank_para,
+                                             tmp_trans_list_by_file, sources,
+                                             file_data, trans_filter)
+        tmp_file_names += [str(trans_file.relative_to(dir_path))] * (
+            len(tmp_trans_list_by_file) - len(tmp_file_names))
+    # 失败的文件在其他文件解析完后逐个重试，不预读，仍失败则隔离
+    for trans_file, _reason in failed_files.items():
+        for _ in range(st.FILE_RETRIES):
+            format_progress('  重试——', True)
+            _line_num, _reason = parse_trans_file_supervised(
+                trans_file, bank_para, tmp_trans_list_by_file, sources, None,
+                trans_filter)
+            tmp_all_nums += _line_num
+            if _reason is None:
+                break
+        tmp_file_names += [str(trans_file.relative_to(dir_path))] * (
+            len(tmp_trans_list_by_file) - len(tmp_file_names))
+        if _reason is not None:
+            format_error('隔离文件{}（{}）'.format(trans_file.name, _reason))
+            format_progress('')
+            tmp_quarantined.append({
+                '银行': bank_name or dir_path.name,
+                '文件': str(trans_file),
+                '原因': _reason
+            })
+    if quarantined is not None:
+        quarantined.extend(tmp_quarantined)
+    if len(tmp_trans_list_by_file) == 0:
+        format_progress('    ✘没有可解析的流水文件')
+        print_quarantined(dir_path, tmp_quarantined)
+        return None, True
     tmp_trans = pd.concat(tmp_trans_list_by_file,
                           ignore_index=True,
                           sort=False)
-    tmp_trans['银行名称'] = dir_path.name
+    tmp_trans['银行名称'] = bank_name or dir_path.name
     tmp_trans['交易日期'] = pd.to_datetime(tmp_trans['交易日期'], errors='coerce')
-    tmp_trans['交易金额'] = pd.to_numeric(tmp_trans['交易金额'])
+    if fen:
+        for col in ('交易金额', '账户余额'):
+            if col in tmp_trans.columns:
+                tmp_trans[col] = parse_fen(tmp_trans[col])
+    else:
+        tmp_trans['交易金额'] = pd.to_numeric(tmp_trans['交易金额'])
+    dup_nums = 0  # 与其他文件重复的行数
+    if dedup:  # 须在推断收支方向前去重，否则重复行会干扰余额差
+        file_codes = np.repeat(np.arange(len(tmp_trans_list_by_file)),
+                               [len(_df) for _df in tmp_trans_list_by_file])
+        tmp_trans, overlaps = drop_duplicate_trans(tmp_trans, file_codes,
+                                                   tmp_file_names)
+        dup_nums = int(overlaps.sum())
+        if dup_nums > 0:
+            format_progress('    去除重复流水{}条：'.format(dup_nums))
+            for (_first, _dup), _num in overlaps.items():
+                format_progress('      【{}】与【{}】重叠{}条'.format(
+                    _dup, _first, _num))
+    ambiguous_nums = 0  # 收支方向存疑的行数
+    head_nums = 0  # 没有上笔余额、保留原符号的各账户首笔交易行数
     if not bank_para.has_minus_amounts:
-        amount_set_minus(tmp_trans,
-                         second_amount_col=bank_para.second_amount_col)
+        ambiguous_nums, head_nums = amount_set_minus(
+            tmp_trans, second_amount_col=bank_para.second_amount_col)
+    if trans_filter is not None:  # 应用推迟到推断收支方向之后的筛选条件
+        _line_num = len(tmp_trans)
+        tmp_trans = trans_filter.apply(tmp_trans)
+        tmp_all_nums -= _line_num - len(tmp_trans)
     format_progress('    分析结束，共解析{}/{}条'.format(len(tmp_trans), tmp_all_nums))
     # 检测结果正确性
     na_nums = tmp_trans.reindex(columns=bank_para.check_cols).isna().sum()
@@ -546,7 +1160,7 @@ def parse_base_dir(dir_path: pathlib.Path,
     if (tmp_trans['户名'].str.find('逐笔明细') != -1).any():
         format_progress('    ✘户名解析不正确。')
         _has_mistakes = True
-    if len(tmp_trans) < tmp_all_nums:
+    if len(tmp_trans) + dup_nums < tmp_all_nums:
         format_progress('    ✘存在未解析数据行。')
         _has_mistakes = True
     if len(na_nums) > 0:
@@ -558,6 +1172,15 @@ def parse_base_dir(dir_path: pathlib.Path,
     if nag_amounts == 0:
         format_progress('    ✘交易金额全为正值。')
         _has_mistakes = True
+    if head_nums > 0:
+        format_progress('    各账户首笔交易没有上笔余额，保留原收支方向{}条。'.format(head_nums))
+    if ambiguous_nums > 0:
+        format_progress('    ✘余额变化与交易金额不符，收支方向存疑{}条（见收支存疑列）。'.format(
+            ambiguous_nums))
+        _has_mistakes = True
+    if len(tmp_quarantined) > 0:
+        print_quarantined(dir_path, tmp_quarantined)
+        _has_mistakes = True
     if _has_mistakes:
         format_progress(
             '✘═══╩════════════════════════════════════════请查找问题，或调整不规范数据！')
@@ -566,31 +1189,89 @@ def parse_base_dir(dir_path: pathlib.Path,
     return tmp_trans, _has_mistakes
 
 
-def format_transactions(base_path: pathlib.Path) -> pd.DataFrame:
+# 返回按交易日期稳定排序的下标，空日期排在最后。各文件的流水已按日期排序，
+# int64的稳定排序（timsort）识别出这些有序段后逐段归并，不必整体重新排序
+def get_date_order(dates: pd.Series) -> np.ndarray:
+    dates = dates.to_numpy(dtype='datetime64[ns]').view('int64')
+    _nat = np.iinfo(np.int64).min
+    dates = np.where(dates == _nat, np.iinfo(np.int64).max, dates)
+    return np.argsort(dates, kind='stable')
+
+
+# provenance为True时，在结果中追加源文件、源工作表（分类编码）和源行号列；
+# trans_filter为筛选条件，在解析各文件时尽早应用；
+# fen为True时金额列（交易金额、账户余额、金额绝对值）为以分为单位的整数，汇总和核对无舍入误差；
+# supervise为True时每个文件在受监控的子进程中解析（超时、内存上限、失败重试），
+# 被隔离的文件以{'银行', '文件', '原因'}追加到quarantined中；
+# summary为字典时，解析完成后按银行生成汇总表并更新到summary中（见update_summary）
+def format_transactions(base_path: pathlib.Path,
+                        dedup: bool = True,
+                        provenance: bool = False,
+                        trans_filter: TransFilter = None,
+                        fen: bool = False,
+                        supervise: bool = False,
+                        quarantined: list = None,
+                        summary: dict = None) -> pd.DataFrame:
     _num_mistakes = 0
+    sources = {col: {} for col in st.SOURCE_COLS[:2]} if provenance else None
     format_progress('开始分析银行流水……')
     tmp_trans_list_by_bank = []
+    tmp_bank_names = []  # 与tmp_trans_list_by_bank对应的银行名称
     tmp_banks_no_support = 0
     for dir in base_path.iterdir():
         try:
             if dir.is_dir():
+                bank_name = dir.name
+                if bank_name not in st.BANK_PARAS:  # 目录名不是已知银行时根据表头识别
+                    bank_name = detect_bank(dir)
+                    if bank_name is None:
+                        raise KeyError(dir.name)
+                    format_progress('目录{}识别为{}'.format(dir.name, bank_name))
                 _tmp_trans, _has_mistakes = parse_base_dir(
-                    dir, st.BANK_PARAS[dir.name])
+                    dir, st.BANK_PARAS[bank_name], dedup, sources,
+                    trans_filter, bank_name, fen, supervise, quarantined)
                 if _has_mistakes:
                     _num_mistakes += 1
-                tmp_trans_list_by_bank.append(_tmp_trans)
+                if _tmp_trans is not None:
+                    tmp_trans_list_by_bank.append(_tmp_trans)
+                    tmp_bank_names.append(bank_name)
         except KeyError as k:
             tmp_banks_no_support += 1
             format_progress('暂不支持{}'.format(k))
+    if len(tmp_trans_list_by_bank) == 0:  # 所有文件都无法解析或被隔离
+        format_error('没有解析出任何流水')
+        return pd.DataFrame(columns=st.COLUMN_ORDER, dtype=object)
+    if summary is not None:
+        # 多个目录可能识别为同一银行，须合并本次解析的全部目录后再生成该银行的汇总，
+        # 逐目录替换会使后一个目录覆盖前一个目录的汇总
+        _trans_by_bank = {}
+        for _bank, _tmp_trans in zip(tmp_bank_names, tmp_trans_list_by_bank):
+            _trans_by_bank.setdefault(_bank, []).append(_tmp_trans)
+        for _bank_trans in _trans_by_bank.values():
+            update_summary(
+                summary, _bank_trans[0] if len(_bank_trans) == 1 else
+                pd.concat(_bank_trans, ignore_index=True, sort=False))
     transactions = pd.concat(tmp_trans_list_by_bank,
                              ignore_index=True,
                              sort=False)
-    transactions = transactions.reindex(columns=st.COLUMN_ORDER)
+    if provenance:
+        transactions = transactions.reindex(columns=st.COLUMN_ORDER +
+                                            st.SOURCE_COLS)
+        # 将编码转换为分类，类别即本次运行的来源登记表，不复制字符串
+        sources['源文件'] = {
+            str(pathlib.Path(_file).relative_to(base_path)): _code
+            for _file, _code in sources['源文件'].items()
+        }
+        for col, names in sources.items():
+            transactions[col] = pd.Categorical.from_codes(
+                transactions[col], categories=list(names))
+    else:
+        transactions = transactions.reindex(columns=st.COLUMN_ORDER)
     transactions.dropna(axis=1, how='all', inplace=True)
     tmp_cols = transactions.select_dtypes(include='object').columns
     for col in tmp_cols:
         transactions[col] = transactions[col].str.strip()
-    transactions.sort_values(by='交易日期', inplace=True)
+    transactions = transactions.take(get_date_order(transactions['交易日期']))
     transactions.dropna(axis=1, how='all', inplace=True)
     # 扩展原始列加速分析
     transactions.insert(9, '金额绝对值', transactions['交易金额'].abs())
@@ -614,9 +1295,170 @@ def write_excel(df: pd.DataFrame, path: pathlib.Path,
     elif content == 'b':
         format_progress('正在写入【账户余额合计（张楠制作）.xlsx】……')
         df.to_excel(path / '账户余额合计（张楠制作）.xlsx', engine='xlsxwriter')
+    elif content == 'r':
+        format_progress('正在写入【账户余额核对（张楠制作）.xlsx】……')
+        df.to_excel(path / '账户余额核对（张楠制作）.xlsx',
+                    index=False,
+                    engine='xlsxwriter')
+    format_progress('写入完成')
+
+
+# 压缩并写入一个CSV分块，在工作线程中执行
+def write_csv_chunk(chunk_path: pathlib.Path, data: bytes,
+                    compression: str) -> None:
+    if compression == 'gzip':
+        data = gzip.compress(data, compresslevel=st.CSV_GZIP_LEVEL)
+    elif compression == 'zstd':
+        data = importlib.import_module('zstandard').ZstdCompressor(
+            level=st.CSV_ZSTD_LEVEL).compress(data)
+    chunk_path.write_bytes(data)
+
+
+# 将规范流水按chunk_rows行一块写入CSV目录，内存中待写入的分块文本不超过CSV_MEMORY字节
+# （至少保留一块）。
+# compression可为None、'gzip'或'zstd'（需安装zstandard），各分块由多个线程并行压缩写入，
+# 目录中的manifest.json记录各分块的文件名和行数
+def write_csv(df: pd.DataFrame,
+              path: pathlib.Path,
+              compression: str = None,
+              chunk_rows: int = None) -> dict:
+    chunk_rows = chunk_rows or st.CSV_CHUNK_ROWS
+    suffix = {None: '', 'gzip': '.gz', 'zstd': '.zst'}[compression]
+    if compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        raise ValueError('zstd压缩需要安装zstandard')
+    csv_dir = path / '规范交易流水（张楠制作）'
+    format_progress('正在写入【{}】……'.format(csv_dir.name))
+    csv_dir.mkdir(exist_ok=True)
+    for old_chunk in csv_dir.glob('*.csv*'):  # 清除上次写入的分块
+        old_chunk.unlink()
+    chunks = []
+    pending = collections.deque()  # 正在压缩写入的分块(任务, 文本字节数)
+    buffered = 0  # 待写入分块的文本总字节数
+    with ThreadPoolExecutor(max_workers=st.CSV_WORKERS) as executor:
+        for begin in range(0, len(df), chunk_rows):
+            chunk = df.iloc[begin:begin + chunk_rows]
+            chunk_name = '{:05d}.csv{}'.format(len(chunks), suffix)
+            data = chunk.to_csv(index=False).encode('utf-8')
+            pending.append((executor.submit(write_csv_chunk,
+                                            csv_dir / chunk_name, data,
+                                            compression), len(data)))
+            buffered += len(data)
+            del data
+            chunks.append({'文件': chunk_name, '行数': len(chunk)})
+            # 限制内存中待写入的分块数和文本总量，等最早的分块写完释放内存
+            while len(pending) > 1 and (len(pending) > st.CSV_WORKERS
+                                        or buffered > st.CSV_MEMORY):
+                future, size = pending.popleft()
+                future.result()
+                buffered -= size
+        for future, _ in pending:
+            future.result()
+    manifest = {
+        '列': list(df.columns),
+        '行数': len(df),
+        '压缩': compression,
+        '分块': chunks,
+    }
+    with open(csv_dir / 'manifest.json', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    format_progress('写入完成，共{}块'.format(len(chunks)))
+    return manifest
+
+
+# 以Arrow IPC（Feather）格式保存规范流水。不压缩，以便读取时直接内存映射，
+# 多个进程读取同一文件时共享系统页缓存。不保存行索引
+def write_feather(df: pd.DataFrame, path: pathlib.Path) -> None:
+    feather = importlib.import_module('pyarrow.feather')
+    format_progress('正在写入【{}】……'.format(st.FEATHER_FILE_NAME))
+    feather.write_feather(df.reset_index(drop=True),
+                          path / st.FEATHER_FILE_NAME,
+                          compression='uncompressed')
+    format_progress('写入完成')
+
+
+# 读取write_feather保存的规范流水，path为文件或其所在目录，columns指定只读取的列。
+# 默认返回DataFrame：所读各列全部转换到内存中，字符串列逐个转换为Python对象，
+# 内存占用与所读数据量成正比，只有内存映射的文件本身在进程间共享，大文件应通过columns只读所需列。
+# as_arrow为True时返回pyarrow.Table，数据保留在内存映射中，各列在被访问时才从磁盘读入
+def read_feather(path: pathlib.Path,
+                 columns: List[str] = None,
+                 as_arrow: bool = False) -> pd.DataFrame:
+    feather = importlib.import_module('pyarrow.feather')
+    if path.is_dir():
+        path = path / st.FEATHER_FILE_NAME
+    table = feather.read_table(path, columns=columns, memory_map=True)
+    if as_arrow:
+        return table
+    return table.to_pandas(split_blocks=True)
+
+
+# 生成汇总表：月度收支为各账户每月收入、支出的笔数和金额；主要对手为各账户交易金额
+# （绝对值之和）最大的SUMMARY_TOP_K个交易对手。账户以银行名称、户名和账号（无账号时用卡号）区分，
+# 金额单位与交易金额相同。返回{汇总表名称: 汇总表}
+def build_summary(trans: pd.DataFrame) -> dict:
+    keys = trans.reindex(
+        columns=['银行名称', '户名', '账号', '卡号', '对方户名', '对方账号'])
+    keys['账号'] = keys['账号'].fillna(keys['卡号'])
+    del keys['卡号']
+    for col in keys.columns:
+        keys[col] = keys[col].fillna('').astype(str).str.strip()
+    acc_cols = ['银行名称', '户名', '账号']
+    frame = keys[acc_cols].assign(
+        月份=trans['交易日期'].to_numpy(dtype='datetime64[M]').astype(
+            'datetime64[ns]'),
+        方向=np.where(get_amount_array(trans['交易金额']) < 0, '支出', '收入'),
+        金额=trans['交易金额'].array)
+    monthly = frame.groupby(acc_cols + ['月份', '方向'])['金额'].agg(
+        笔数='size', 金额='sum').reset_index()
+
+    frame = keys.assign(金额=trans['交易金额'].abs().array)
+    targets = frame.groupby(acc_cols + ['对方户名', '对方账号'],
+                            sort=False)['金额'].agg(笔数='size',
+                                                   金额='sum').reset_index()
+    targets = targets[(targets['对方户名'] != '') | (targets['对方账号'] != '')]
+    targets = targets.sort_values(by=['金额', '笔数'],
+                                  ascending=False,
+                                  kind='stable')
+    targets = targets.groupby(acc_cols, sort=False).head(st.SUMMARY_TOP_K)
+    targets = targets.sort_values(by=acc_cols,
+                                  kind='stable').reset_index(drop=True)
+    targets.insert(3, '排名', targets.groupby(acc_cols).cumcount() + 1)
+    return {'月度收支': monthly, '主要对手': targets}
+
+
+# 用trans重新生成其中各银行的汇总，替换summary中这些银行原有的部分，其他银行不变
+def update_summary(summary: dict, trans: pd.DataFrame) -> None:
+    banks = trans['银行名称'].unique()
+    for name, table in build_summary(trans).items():
+        if name in summary:
+            table = pd.concat(
+                [summary[name][~summary[name]['银行名称'].isin(banks)], table],
+                ignore_index=True,
+                sort=False)
+        summary[name] = table
+
+
+def write_summary(summary: dict, path: pathlib.Path) -> None:
+    feather = importlib.import_module('pyarrow.feather')
+    for name, table in summary.items():
+        format_progress('正在写入【{}】……'.format(st.SUMMARY_FILE_NAMES[name]))
+        feather.write_feather(table.reset_index(drop=True),
+                              path / st.SUMMARY_FILE_NAMES[name],
+                              compression='uncompressed')
     format_progress('写入完成')
 
 
+# 读取write_summary保存的汇总表，返回{汇总表名称: 汇总表}，不存在的表跳过
+def read_summary(path: pathlib.Path) -> dict:
+    feather = importlib.import_module('pyarrow.feather')
+    return {
+        name: feather.read_table(path / file_name,
+                                 memory_map=True).to_pandas()
+        for name, file_name in st.SUMMARY_FILE_NAMES.items()
+        if (path / file_name).exists()
+    }
+
+
 # 解析账户文件
 def parse_accounts_file(base_path: pathlib.Path) -> pd.DataFrame:
     format_progress('开始解析银行账户余额……')
@@ -635,40 +1477,214 @@ def parse_accounts_file(base_path: pathlib.Path) -> pd.DataFrame:
     return tmp_acc
 
 
-# 计算账户余额
-def count_balances(base_path: pathlib.Path) -> pd.DataFrame:
-    tmp_acc = parse_accounts_file(base_path)
-    # 去除非数字余额和零余额，只保留户名、银行和余额
-    tmp_acc = tmp_acc[~tmp_acc['当前余额'].str.match(r'^\D+$|^0$', na=True)][[
+# 将币种写法统一为ISO代码（如“（美元）”“美元”“USD”均为USD），空值视为人民币。
+# 只对不重复的写法查表，返回分类数据
+def normalize_currency(currency: pd.Series) -> pd.Categorical:
+    codes, uniques = pd.factorize(currency.fillna(''))
+    iso_codes, iso_uniques = pd.factorize(
+        pd.Index([
+            st.CURRENCY_ALIASES.get(
+                _currency.strip(st.CURRENCY_DECO_CHARS).upper(), _currency)
+            for _currency in uniques
+        ],
+                 dtype=object))
+    return pd.Categorical.from_codes(iso_codes[codes], iso_uniques)
+
+
+# 读取本地汇率表（包含币种和汇率两列的xlsx或csv文件），返回{ISO币种代码: 人民币汇率}
+def load_fx_rates(rate_path: pathlib.Path) -> dict:
+    if rate_path.suffix == '.csv':
+        rates = pd.read_csv(rate_path, dtype={'币种': str})
+    else:
+        rates = pd.read_excel(rate_path, dtype={'币种': str})
+    return dict(
+        zip(normalize_currency(rates['币种']),
+            pd.to_numeric(rates['汇率'])))
+
+
+# 拆分账户表余额，每个账户每个币种一行。fen为True时余额以分为单位，
+# keep_zero为True时保留零余额（核对期末余额时零余额也是有效的比对对象）
+def format_balances(tmp_acc: pd.DataFrame,
+                    fen: bool = False,
+                    keep_zero: bool = False) -> pd.DataFrame:
+    # 去除非数字余额（及零余额），只保留户名、银行和余额
+    tmp_acc = tmp_acc[~tmp_acc['当前余额'].str.match(
+        r'^\D+$' if keep_zero else r'^\D+$|^0$', na=True)][[
         '户名', '银行', '当前余额', '卡号或账号'
     ]]
-    # 有币种符号时拆分列
-    _formated_balances = tmp_acc['当前余额'].str.split(
-        '\n', expand=True).stack().reset_index(
-            level=1, drop=True).str.extract(r'(^\D*)(.*)').rename(columns={
-                0: '币种',
-                1: '当前余额'
-            })
-    tmp_acc = tmp_acc.drop('当前余额', axis=1).join(_formated_balances)
-    tmp_acc['币种'] = tmp_acc['币种'].str.replace(r'^$', 'CNY')
-    tmp_acc['当前余额'] = pd.to_numeric(tmp_acc['当前余额'])
-    tmp_acc = tmp_acc.reset_index(drop=True)
-    # 拆分建行币种列
-    _currency = tmp_acc['卡号或账号'].str.extract(r'^(\d+)(\D*)')[1]
-    tmp_acc.loc[_currency.str.match(r'^（\D+）$', na=False), '币种'] = _currency
-    tmp_acc['币种'] = tmp_acc['币种'].str.replace('（美元）', 'USD')
-    tmp_acc['币种'] = tmp_acc['币种'].str.replace('（港币）', 'HKD')
+    # 一次提取各行余额中的币种和金额，多币种余额拆分为多行
+    _formated_balances = tmp_acc['当前余额'].str.extractall(
+        st.BALANCE_PATTERN).reset_index(level=1, drop=True)
+    tmp_acc = tmp_acc.drop('当前余额', axis=1).join(
+        _formated_balances, how='inner').reset_index(drop=True)
+    if fen:
+        tmp_acc['当前余额'] = parse_fen(tmp_acc['当前余额'])
+    else:
+        tmp_acc['当前余额'] = pd.to_numeric(tmp_acc['当前余额'].str.replace(
+            ',', '', regex=False))
+    # 建行在账号后用括号标注币种
+    _currency = tmp_acc['卡号或账号'].str.extract(st.ACCOUNT_CURRENCY_PATTERN)[0]
+    tmp_acc['币种'] = normalize_currency(_currency.fillna(tmp_acc['币种']))
+    return tmp_acc
+
+
+# 计算账户余额。fx_rates为{币种: 人民币汇率}或本地汇率表路径时，
+# 返回的表中增加折合人民币列，并输出折合人民币合计。fen为True时余额以分为单位，按整数精确求和
+def count_balances(base_path: pathlib.Path,
+                   fx_rates: Union[dict, pathlib.Path] = None,
+                   fen: bool = False) -> pd.DataFrame:
+    tmp_acc = format_balances(parse_accounts_file(base_path), fen)
+    tmp_acc['户名'] = tmp_acc['户名'].astype('category')
     # 计算各账户余额
-    tmp_acc = tmp_acc.groupby(['户名', '币种'])['当前余额'].sum()
+    tmp_acc = tmp_acc.groupby(['户名', '币种'],
+                              observed=True)['当前余额'].sum()
+    if fx_rates is not None:
+        if isinstance(fx_rates, dict):
+            fx_rates = dict(
+                zip(normalize_currency(pd.Series(list(fx_rates), dtype=object)),
+                    fx_rates.values()))
+        else:
+            fx_rates = load_fx_rates(fx_rates)
+        fx_rates = dict(fx_rates, CNY=1)
+        _rates = tmp_acc.index.get_level_values('币种').map(fx_rates)
+        tmp_acc = tmp_acc.to_frame()
+        tmp_acc['折合人民币'] = tmp_acc['当前余额'] * _rates.to_numpy(dtype=float)
+        _no_rates = set(tmp_acc.index.get_level_values('币种')) - set(fx_rates)
+        if len(_no_rates) > 0:
+            format_error('缺少以下币种汇率：' + str(_no_rates))
+        format_progress('折合人民币合计{:.2f}元'.format(
+            tmp_acc['折合人民币'].sum() / (100 if fen else 1)))
     format_progress('账户余额计算完毕')
     return tmp_acc
 
 
+# 将银行名称统一为解析参数中的银行名：账户表的银行取自工作表名，可能带有前后缀，
+# 取名称中包含的最长的已知银行名，都不包含时保留原名称
+def get_bank_keys(banks: pd.Series) -> np.ndarray:
+    codes, uniques = pd.factorize(banks.fillna('').astype(str))
+    known = sorted(st.BANK_PARAS, key=len, reverse=True)
+    keys = [
+        next((_bank for _bank in known if _bank in _name), _name.strip())
+        for _name in uniques
+    ]
+    return np.array(keys, dtype=object)[codes]
+
+
+# 核对账户余额：按（银行名称、账号/卡号、币种）分组，逐行检查“上笔余额+交易金额=本笔余额”，
+# 并将各账户期末余额与账户基本情况表比对，返回差异明细。base_path为None时只做连续性检查。
+# 金额以分为单位时精确比较，差异明细中的金额也以分为单位
+def reconcile_balances(df: pd.DataFrame,
+                       base_path: pathlib.Path = None) -> pd.DataFrame:
+    format_progress('开始核对账户余额……')
+    keys = df.reindex(columns=['银行名称', '账号', '卡号', '币种'])
+    keys['账号'] = keys['账号'].fillna(keys['卡号'])
+    # 币种统一为ISO代码，与账户表按（号码, 币种）比对
+    keys['币种'] = np.asarray(normalize_currency(keys['币种']), dtype=object)
+    codes = keys.groupby(['银行名称', '账号', '币种'], sort=False,
+                         dropna=False).ngroup().to_numpy()
+    dates = df['交易日期'].to_numpy(dtype='datetime64[ns]').view('int64')
+    order = np.lexsort((dates, codes))  # 稳定排序，同一时间的交易保持原始顺序
+    codes = codes[order]
+    amounts = get_amount_array(df['交易金额'])[order]
+    balances = get_amount_array(df.reindex(columns=['账户余额'])['账户余额'])[order]
+    fen = is_fen(df['交易金额'])
+    tolerance = 0 if fen else st.BALANCE_TOLERANCE
+
+    # 错位比较相邻两行，余额为空的行不参与比较
+    same_acc = codes[1:] == codes[:-1]
+    expected = balances[:-1] + amounts[1:]
+    broken = same_acc & (np.abs(balances[1:] - expected) > tolerance)
+    broken_lines = order[1:][broken]
+    reports = [
+        pd.DataFrame({
+            '问题': '余额不连续',
+            '流水索引': df.index[broken_lines],
+            '银行名称': keys['银行名称'].to_numpy()[broken_lines],
+            '账号': keys['账号'].to_numpy()[broken_lines],
+            '币种': keys['币种'].to_numpy()[broken_lines],
+            '交易日期': df['交易日期'].to_numpy()[broken_lines],
+            '期望余额': expected[broken],
+            '实际余额': balances[1:][broken],
+        })
+    ]
+
+    # 各账户最后一笔有余额的交易即为期末余额
+    if base_path is not None:
+        sorted_keys = pd.DataFrame({
+            '_组': codes,
+            '银行名称': keys['银行名称'].to_numpy()[order],
+            '账号': keys['账号'].to_numpy()[order],
+            '卡号': keys['卡号'].to_numpy()[order],
+            '币种': keys['币种'].to_numpy()[order],
+            '交易日期': df['交易日期'].to_numpy()[order],
+            '实际余额': balances,
+        })
+        sorted_keys = sorted_keys[~np.isnan(balances)]
+        # 取每组最后一整行，不能用last()：它按列分别取最后的非空值，会混合不同行的字段
+        finals = sorted_keys.groupby('_组', sort=False).tail(1).set_index('_组')
+        finals['_银行'] = get_bank_keys(finals['银行名称'])
+        acc_balances = format_balances(parse_accounts_file(base_path), fen,
+                                       keep_zero=True)
+        acc_balances['_号码'] = acc_balances['卡号或账号'].str.extract(
+            r'^\s*(\d+)')[0]
+        acc_balances['币种'] = acc_balances['币种'].astype(object)
+        acc_balances['_银行'] = get_bank_keys(acc_balances['银行'])
+        # 账户表中的号码可能是账号也可能是卡号，两者均参与匹配，
+        # 不同银行的相同号码、同一号码的不同币种分别比对
+        candidates = pd.concat([finals['账号'], finals['卡号']
+                                ]).rename('_号码').dropna().reset_index()
+        candidates['币种'] = finals.loc[candidates['_组'], '币种'].to_numpy()
+        candidates['_银行'] = finals.loc[candidates['_组'], '_银行'].to_numpy()
+        candidates = candidates.drop_duplicates().merge(
+            acc_balances[['_号码', '币种', '_银行', '当前余额']],
+            on=['_号码', '币种', '_银行'])
+        candidates['_相符'] = np.abs(
+            get_amount_array(candidates['当前余额']) -
+            finals.loc[candidates['_组'], '实际余额'].to_numpy()) <= tolerance
+        # 有相符的余额时不报告，否则期望余额取第一个同号码同币种的余额
+        candidates.sort_values(by='_相符', ascending=False, kind='stable',
+                               inplace=True)
+        _first = candidates.drop_duplicates(subset='_组').set_index('_组')
+        finals['期望余额'] = _first['当前余额']
+        _acc_numbers = pd.MultiIndex.from_frame(acc_balances[['_银行', '_号码']])
+        _known = pd.MultiIndex.from_frame(finals[['_银行', '账号']]).isin(
+            _acc_numbers) | pd.MultiIndex.from_frame(
+                finals[['_银行', '卡号']]).isin(_acc_numbers)
+        finals['问题'] = np.where(_known, '账户表无此币种', '账户表无此账号')
+        finals.loc[_first.index[~_first['_相符']], '问题'] = '期末余额不符'
+        finals = finals[~finals.index.isin(_first.index[_first['_相符']])]
+        reports.append(
+            finals.drop(columns=['卡号', '_银行']).reset_index(drop=True))
+        # 账户表中有余额但没有流水的账户（银行、号码和币种均须对应）
+        no_trans = acc_balances[~pd.MultiIndex.from_frame(
+            acc_balances[['_银行', '_号码', '币种']]).isin(
+                pd.MultiIndex.from_frame(candidates[['_银行', '_号码', '币种']]))]
+        reports.append(
+            pd.DataFrame({
+                '问题': '账户表账号无流水',
+                '银行名称': no_trans['银行'],
+                '账号': no_trans['卡号或账号'],
+                '币种': no_trans['币种'],
+                '期望余额': no_trans['当前余额'],
+            }))
+
+    report = pd.concat(reports, ignore_index=True, sort=False)
+    report['差额'] = report['实际余额'] - report['期望余额']
+    if fen:
+        for col in ('期望余额', '实际余额', '差额'):
+            report[col] = report[col].astype(float).round().astype(st.FEN_DTYPE)
+    format_progress('账户余额核对完毕，发现差异{}处'.format(len(report)))
+    return report
+
+
 # 根据自身数据补全对手户名
 def fill_target_names(df: pd.DataFrame):
     format_progress('开始补全对手户名……')
-    # 提取基础户名账号配对
-    base_names = df[['户名', '账号', '卡号']].reset_index(drop=True)
+    if '对方账号' not in df.columns or '对方户名' not in df.columns:
+        format_progress('流水中没有对方账号或对方户名，跳过补全')
+        return
+    # 提取基础户名账号配对，没有账号或卡号列的银行按空列处理
+    base_names = df.reindex(columns=['户名', '账号', '卡号']).reset_index(drop=True)
     base_names = base_names.drop(columns=['账号', '卡号']).join(
         base_names[['账号', '卡号']].stack().reset_index(
             level=1, drop=True).rename('账号'))
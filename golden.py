@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+# 解析结果回归检查，用法：python golden.py [--update [--regenerate]] [--dir 快照目录] [银行名称……]
+# 快照目录纳入版本库，包括fixtures子目录中各银行的模拟流水、解析结果的Parquet快照和内存峰值基准。
+# 检查时用format_transactions重新解析保存的模拟流水，将结果与快照逐值、逐类型比对，
+# 内存峰值不超出基准；解析输出中有自检问题（✘开头的提示）或结果不合常理（账号非文本、
+# 账户没有支出）时不通过，--update时也不记录这样的快照。
+# 用时与机器有关，基准只记录在本机的timings.json中（不纳入版本库），首次检查时记录。
+# --update时重新记录快照和基准，没有模拟流水的银行按其当前解析参数生成；
+# --regenerate时所有模拟流水都重新生成。更新后的快照须连同代码改动一起审阅提交
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import shutil
+import sys
+import time
+import tracemalloc
+import statics as st
+
+# 每个账户的模拟流水行数，每家银行两个账户
+FIXTURE_ROWS = 200
+# 计时取多次运行的最小值
+TIMING_RUNS = 3
+# 相对基准允许的用时和内存峰值倍数，以及用时（秒）和内存峰值（字节）的绝对余量，用于吸收测量噪声
+TIME_RATIO = 1.5
+TIME_SLACK = 0.1
+MEMORY_RATIO = 1.2
+MEMORY_SLACK = 2**20
+BUDGET_FILE_NAME = 'budgets.json'
+TIMING_FILE_NAME = 'timings.json'
+
+
+# 生成一个账户的规范字段模拟流水，金额为正，方向由directions给出（True为支出），余额连续
+def make_account_rows(name: str, account: str, rows: int, seed: int):
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    amounts = rng.integers(100, 10**6, rows) / 100
+    directions = rng.random(rows) < 0.5
+    balances = 10**6 + np.cumsum(np.where(directions, -amounts, amounts))
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(
+        np.arange(rows) * 7 * 3600 + seed, unit='s')
+    return pd.DataFrame({
+        '户名': name,
+        '账号': account,
+        '交易日期': dates.strftime('%Y-%m-%d %H:%M:%S'),
+        '交易金额': ['{:.2f}'.format(_amount) for _amount in amounts],
+        '账户余额': ['{:.2f}'.format(_balance) for _balance in balances],
+        '币种': '人民币',
+        '交易方式': rng.choice(['柜面', '网银', 'ATM'], rows),
+        '摘要': rng.choice(['转账', '消费', '工资'], rows),
+        '备注': '备注',
+        '附言': '附言',
+        '对方户名': rng.choice(['甲公司', '乙有限公司', '丙'], rows),
+        '对方账号': rng.choice(['6222000000001', '6222000000002', '9999'],
+                            rows),
+        '对方开户行': '某支行',
+        '交易网点': '001',
+        '交易代码': 'T01',
+        '柜员号': 'G01',
+    }), directions
+
+
+# 模拟账户：户名、账号和随机种子
+FIXTURE_ACCOUNTS = [('张三', '6222000000001', 1), ('李四', '6222000000002', 2)]
+
+
+# 按银行的列映射将规范字段换成原始列名，没有映射且未被占用的字段沿用规范列名
+def to_source_cols(trans, bank_para: st.BankPara):
+    col_map = bank_para.col_map or {}
+    columns = {}
+    for col in trans.columns:
+        sources = [_key for _key, _value in col_map.items() if _value == col]
+        if len(sources) > 0:
+            columns[col] = sources[0]
+        elif col not in col_map:
+            columns[col] = col
+    return trans[list(columns)].rename(columns=columns)
+
+
+# 一般银行：按收支方向的表示方式（负数金额、借贷两列、收付标志或仅余额）生成工作簿，
+# 户名按参数放在户名列、文件名、目录名或工作表名中
+def make_common_fixture(bank_dir: pathlib.Path, bank_para: st.BankPara) -> None:
+    import numpy as np
+    import pandas as pd
+    for name, account, seed in FIXTURE_ACCOUNTS:
+        trans, directions = make_account_rows(name, account, FIXTURE_ROWS, seed)
+        if bank_para.has_minus_amounts:
+            trans.loc[directions, '交易金额'] = '-' + trans.loc[directions,
+                                                            '交易金额']
+        elif bank_para.second_amount_col is not None:
+            trans[bank_para.second_amount_col] = np.where(
+                directions, '0.00', trans['交易金额'])
+            trans.loc[~directions, '交易金额'] = '0.00'
+        if '借贷标志' in bank_para.check_cols:
+            trans['借贷标志'] = np.where(directions, '借', '贷')
+        file_dir, file_name = bank_dir, name
+        if bank_para.use_dir_name:
+            file_dir = bank_dir / name
+            del trans['户名']
+        elif bank_para.deco_strings is not None:
+            file_name = name + bank_para.deco_strings
+            del trans['户名']
+        trans = to_source_cols(trans, bank_para)
+        if bank_para.footer > 0:
+            trans = pd.concat([
+                trans,
+                pd.DataFrame({trans.columns[0]: ['合计'] * bank_para.footer})
+            ],
+                              ignore_index=True)
+        sheet = {'户名': name, '账号': account}.get(bank_para.sheet_name_is, '流水')
+        file_dir.mkdir(parents=True, exist_ok=True)
+        trans.to_excel(file_dir / (file_name + '.xlsx'),
+                       sheet_name=sheet,
+                       index=False)
+
+
+# 邮储银行：表头前5行为账户信息，表尾3行
+def make_psbc_fixture(bank_dir: pathlib.Path) -> None:
+    import pandas as pd
+    bank_dir.mkdir(parents=True)
+    with pd.ExcelWriter(bank_dir / '邮储流水.xlsx') as writer:
+        for name, account, seed in FIXTURE_ACCOUNTS:
+            trans = make_account_rows(name, account, FIXTURE_ROWS, seed)[0]
+            head = pd.DataFrame([['账户交易明细'],
+                                 ['账号:{} 户名:{}'.format(account, name)],
+                                 ['查询范围'], ['币种:人民币 钞汇:钞'], ['单位:元']])
+            head.to_excel(writer, sheet_name=name, index=False, header=False)
+            trans = trans.drop(columns=['户名', '账号', '币种']).rename(
+                columns={
+                    '交易方式': '交易渠道',
+                    '交易网点': '交易机构名称',
+                    '对方账号': '对方账号/卡号/汇票号',
+                    '对方开户行': '对方开户机构',
+                })
+            trans.to_excel(writer, sheet_name=name, index=False, startrow=5)
+            pd.DataFrame([['合计'], ['打印人'], ['打印时间']]).to_excel(
+                writer,
+                sheet_name=name,
+                index=False,
+                header=False,
+                startrow=6 + len(trans))
+
+
+# 宁夏银行：表头前6行为户名、账号和卡号
+def make_bonx_fixture(bank_dir: pathlib.Path) -> None:
+    import numpy as np
+    import pandas as pd
+    bank_dir.mkdir(parents=True)
+    with pd.ExcelWriter(bank_dir / '宁夏流水.xlsx') as writer:
+        for name, account, seed in FIXTURE_ACCOUNTS:
+            trans, directions = make_account_rows(name, account, FIXTURE_ROWS,
+                                                  seed)
+            head = pd.DataFrame([['账户交易明细'], ['户名：' + name], ['账号：' + account],
+                                 ['卡号：' + account[::-1]], ['查询范围'], ['单位：元']])
+            head.to_excel(writer, sheet_name=name, index=False, header=False)
+            trans['借贷标识'] = np.where(directions, '借', '贷')
+            trans = trans.drop(columns=['户名', '账号']).rename(
+                columns={
+                    '交易网点': '交易机构',
+                    '交易方式': '交易类型',
+                    '对方开户行': '对方行名',
+                    '对方户名': '对方名称',
+                })
+            trans.to_excel(writer, sheet_name=name, index=False, startrow=6)
+
+
+# 平安银行：表头前6行为账户信息，借方、贷方金额分两列且带千分位，表尾2行
+def make_pab_fixture(bank_dir: pathlib.Path) -> None:
+    import numpy as np
+    import pandas as pd
+    bank_dir.mkdir(parents=True)
+    with pd.ExcelWriter(bank_dir / '平安流水.xlsx') as writer:
+        for name, account, seed in FIXTURE_ACCOUNTS:
+            trans, directions = make_account_rows(name, account, FIXTURE_ROWS,
+                                                  seed)
+            head = pd.DataFrame([['账户交易明细', '', '', ''],
+                                 ['账号', account, '户名', name],
+                                 ['卡号', account[::-1], '', ''], ['查询范围', '', '', ''],
+                                 ['', '', '币种', '人民币'], ['单位：元', '', '', '']])
+            head.to_excel(writer, sheet_name=name, index=False, header=False)
+            amounts = pd.to_numeric(trans['交易金额']).map('{:,.2f}'.format)
+            trans['借方发生额'] = np.where(directions, amounts, '0.00')
+            trans['贷方发生额'] = np.where(directions, '0.00', amounts)
+            trans = trans.drop(columns=['户名', '账号', '币种', '交易金额']).rename(
+                columns={
+                    '对方户名': '交易对方户名',
+                    '对方账号': '交易对方账号',
+                    '对方开户行': '交易对方行名称',
+                })
+            trans.to_excel(writer, sheet_name=name, index=False, startrow=6)
+            pd.DataFrame([['合计'], ['打印时间']]).to_excel(writer,
+                                                    sheet_name=name,
+                                                    index=False,
+                                                    header=False,
+                                                    startrow=7 + len(trans))
+
+
+# 华夏银行：首行即表头
+def make_hxb_fixture(bank_dir: pathlib.Path) -> None:
+    import numpy as np
+    import pandas as pd
+    bank_dir.mkdir(parents=True)
+    with pd.ExcelWriter(bank_dir / '华夏流水.xlsx') as writer:
+        for name, account, seed in FIXTURE_ACCOUNTS:
+            trans, directions = make_account_rows(name, account, FIXTURE_ROWS,
+                                                  seed)
+            trans['借贷标志'] = np.where(directions, '借', '贷')
+            trans.rename(columns={
+                '户名': '客户名称',
+                '交易日期': '过账日期',
+                '交易方式': '业务类型',
+                '交易金额': '发生额',
+                '账户余额': '余额',
+                '对方户名': '对方户名(或商户名称)',
+                '对方账号': '对方账号(或商户编号)',
+                '对方开户行': '对方银行',
+            }).to_excel(writer, sheet_name=name, index=False)
+
+
+# 建设银行：活期、定期各一个工作表，跳过前8行，每个账户一段，段首为账户信息行和表头行，
+# 借方、贷方金额分别在第6、7列
+def make_ccb_fixture(bank_dir: pathlib.Path) -> None:
+    import numpy as np
+    import pandas as pd
+    bank_dir.mkdir(parents=True)
+    header = [
+        '交易日期', '交易卡号', '摘要', '交易渠道', '交易机构名称', '借方发生额', '贷方发生额', '账户余额',
+        '对方户名', '对方账号', '对方行名', '交易备注'
+    ]
+    with pd.ExcelWriter(bank_dir / '建行流水.xlsx') as writer:
+        for sheet, rows, suffix in (('企业活期明细信息', FIXTURE_ROWS, ''),
+                                    ('企业定期明细信息', 5, '01')):
+            lines = [['建设银行账户明细']] * 8
+            for name, account, seed in FIXTURE_ACCOUNTS:
+                account += suffix  # 定期为单独的账号
+                trans, directions = make_account_rows(name, account, rows,
+                                                      seed)
+                lines.append([
+                    '户名:{}，客户编号:{}，账号:{}，开户机构:某支行，币种:人民币'.format(
+                        name, seed, account)
+                ])
+                lines.append(header)
+                lines.extend(
+                    zip(trans['交易日期'], trans['账号'], trans['摘要'],
+                        trans['交易方式'], trans['交易网点'],
+                        np.where(directions, trans['交易金额'], '0.00'),
+                        np.where(directions, '0.00', trans['交易金额']),
+                        trans['账户余额'], trans['对方户名'], trans['对方账号'],
+                        trans['对方开户行'], trans['备注']))
+            pd.DataFrame(lines).to_excel(writer,
+                                         sheet_name=sheet,
+                                         index=False,
+                                         header=False)
+
+
+# 中国银行：新线账号、新线交易、旧线账号、旧线交易和20150701后交易五个工作表
+def make_boc_fixture(bank_dir: pathlib.Path) -> None:
+    import numpy as np
+    import pandas as pd
+    bank_dir.mkdir(parents=True)
+    new_line, old_line, newer = [], [], []
+    for name, account, seed in FIXTURE_ACCOUNTS:
+        trans, directions = make_account_rows(name, account, FIXTURE_ROWS, seed)
+        trans['借贷'] = np.where(directions, '借', '贷')
+        trans = trans.rename(
+            columns={
+                '户名': '姓名',
+                '交易日期': '交易发生日',
+                '账户余额': '交易后金额',
+                '对方户名': '对方姓名',
+                '交易方式': '交易类型',
+                '交易网点': '交易机构名称',
+                '交易代码': '交易码',
+                '币种': '货币',
+            })
+        _third = len(trans) // 3
+        new_line.append(trans.iloc[:_third].rename(columns={'账号': '子账号'}))
+        old_line.append(trans.iloc[_third:2 * _third].assign(
+            账号='OLD' + account))
+        newer.append(trans.iloc[2 * _third:].rename(columns={'账号': '交易账号'}))
+    accounts = pd.DataFrame({
+        '姓名': ['张三', '张三', '李四'],
+        'B': '',
+        'C': '',
+        '子账号': ['6222000000001', '6222000000001', '6222000000002'],
+        'E': '',
+        '卡号': ['C11', 'C12', 'C21'],
+        'G': '',
+        'H': '',
+        '旧账号': ['OLD6222000000001', 'OLD6222000000001', 'OLD6222000000002'],
+    })
+    old_accounts = pd.DataFrame({
+        'A': '',
+        'B': '',
+        '卡号': accounts['卡号'],
+        '账号': accounts['旧账号']
+    })
+    old_cols = [
+        '账号', '姓名', '交易发生日', '借贷', '交易金额', '交易后金额', '对方姓名', '对方账号', '交易类型',
+        '交易机构名称', '交易码', '摘要', '货币'
+    ]
+    newer_cols = ['交易账号', '姓名', '交易发生日', '借贷', '交易金额', '交易后金额', '对方姓名']
+    newer_cols += ['跳过'] + ['对方账号', '交易类型', '交易机构名称', '交易码', '摘要', '货币']
+    newer = pd.concat(newer, ignore_index=True).assign(跳过='')
+    for _col in range(31 - len(newer_cols)):  # 补齐到AE列
+        newer_cols.append('备用{}'.format(_col))
+        newer[newer_cols[-1]] = ''
+    with pd.ExcelWriter(bank_dir / '中行流水.xlsx') as writer:
+        accounts.to_excel(writer, sheet_name='新线账号', index=False)
+        pd.concat(new_line).to_excel(writer, sheet_name='新线交易', index=False)
+        old_accounts.to_excel(writer, sheet_name='旧线账号', index=False)
+        pd.concat(old_line)[old_cols].to_excel(writer,
+                                               sheet_name='旧线交易',
+                                               index=False)
+        newer[newer_cols].to_excel(writer, sheet_name='20150701后交易', index=False)
+
+
+SPECIAL_FIXTURES = {
+    '邮储银行': make_psbc_fixture,
+    '宁夏银行': make_bonx_fixture,
+    '平安银行': make_pab_fixture,
+    '华夏银行': make_hxb_fixture,
+    '建设银行': make_ccb_fixture,
+    '中国银行': make_boc_fixture,
+}
+
+
+def make_fixture(case_dir: pathlib.Path, bank: str) -> None:
+    bank_para = st.BANK_PARAS[bank]
+    if bank_para.special_func is not None:
+        SPECIAL_FIXTURES[bank_para.special_func](case_dir / bank)
+    else:
+        make_common_fixture(case_dir / bank, bank_para)
+
+
+# 解析案件目录，返回结果和解析输出
+def run_parser(case_dir: pathlib.Path):
+    import core
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        result = core.format_transactions(case_dir, provenance=True)
+    return result, log.getvalue()
+
+
+# 解析输出中的自检问题和结果中不合常理之处
+def get_problems(result, log: str) -> list:
+    problems = [line.strip() for line in log.splitlines() if '✘' in line]
+    for col in ('账号', '卡号'):
+        if col in result.columns and result[col].dtype != object:
+            problems.append('{}列为{}类型'.format(col, result[col].dtype))
+    if '账号' in result.columns:
+        _minimums = result.groupby('账号')['交易金额'].min()
+        for account in _minimums.index[_minimums >= 0]:
+            problems.append('账户{}没有支出'.format(account))
+    return problems
+
+
+# 解析案件目录中的模拟流水，返回(结果, 解析输出, 最短用时, 最小内存峰值)
+def measure_bank(case_dir: pathlib.Path):
+    result, log = run_parser(case_dir)  # 预热，导入解析所需模块
+    seconds = []
+    for _ in range(TIMING_RUNS):
+        start = time.perf_counter()
+        run_parser(case_dir)
+        seconds.append(time.perf_counter() - start)
+    peaks = []
+    for _ in range(TIMING_RUNS):
+        tracemalloc.start()
+        run_parser(case_dir)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return result, log, min(seconds), min(peaks)
+
+
+# budgets为{银行: 内存峰值}，timings为本机的{银行: 用时}
+def check_bank(bank: str,
+               snapshot_dir: pathlib.Path,
+               budgets: dict,
+               timings: dict,
+               update: bool,
+               regenerate: bool = False) -> bool:
+    import pandas as pd
+    snapshot = snapshot_dir / (bank + '.parquet')
+    case_dir = snapshot_dir / 'fixtures' / bank
+    if update and (regenerate or not case_dir.exists()):
+        shutil.rmtree(case_dir, ignore_errors=True)
+        make_fixture(case_dir, bank)
+    elif not update and not (case_dir.exists() and snapshot.exists()
+                             and bank in budgets):
+        print('✘{}：没有快照，请先运行--update'.format(bank))
+        return False
+    try:
+        result, log, seconds, peak = measure_bank(case_dir)
+    except Exception as e:
+        print('✘{}：解析失败（{!r}）'.format(bank, e))
+        return False
+    problems = get_problems(result, log)
+    if update:
+        if len(problems) > 0:  # 不记录有问题的结果，须先修正解析方法或模拟流水
+            print('✘{}：结果有问题，未更新快照：{}'.format(bank, '；'.join(problems)))
+            return False
+        result.to_parquet(snapshot)
+        budgets[bank] = peak
+        timings[bank] = seconds
+        print('✔{}：已更新快照，{}行，用时{:.3f}秒，内存峰值{:.1f}MB'.format(
+            bank, len(result), seconds, peak / 1024**2))
+        return True
+    try:
+        pd.testing.assert_frame_equal(result,
+                                      pd.read_parquet(snapshot),
+                                      check_exact=True)
+    except AssertionError as e:
+        problems.append('结果与快照不一致：' + str(e).strip().replace('\n', ' '))
+    if bank not in timings:  # 本机首次检查，记录用时基准
+        timings[bank] = seconds
+    time_budget = max(timings[bank] * TIME_RATIO, timings[bank] + TIME_SLACK)
+    if seconds > time_budget:
+        problems.append('用时{:.3f}秒超出预算{:.3f}秒'.format(seconds, time_budget))
+    memory_budget = max(budgets[bank] * MEMORY_RATIO,
+                        budgets[bank] + MEMORY_SLACK)
+    if peak > memory_budget:
+        problems.append('内存峰值{:.1f}MB超出预算{:.1f}MB'.format(
+            peak / 1024**2, memory_budget / 1024**2))
+    if len(problems) > 0:
+        print('✘{}：{}'.format(bank, '；'.join(problems)))
+        return False
+    print('✔{}：{}行，用时{:.3f}秒（预算{:.3f}秒），内存峰值{:.1f}MB（预算{:.1f}MB）'.format(
+        bank, len(result), seconds, time_budget, peak / 1024**2,
+        memory_budget / 1024**2))
+    return True
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='检查各银行解析结果与快照一致且性能未退化')
+    parser.add_argument('banks', nargs='*', help='要检查的银行，默认全部')
+    parser.add_argument('--update', action='store_true', help='重新记录快照和性能基准')
+    parser.add_argument('--regenerate',
+                        action='store_true',
+                        help='与--update同用，按当前解析参数重新生成模拟流水')
+    parser.add_argument('--dir',
+                        type=pathlib.Path,
+                        default=pathlib.Path(__file__).parent / 'golden',
+                        help='快照目录')
+    args = parser.parse_args(argv)
+    banks = args.banks or list(st.BANK_PARAS)
+    args.dir.mkdir(parents=True, exist_ok=True)
+    budget_file = args.dir / BUDGET_FILE_NAME
+    timing_file = args.dir / TIMING_FILE_NAME
+    budgets, timings = [
+        json.loads(_file.read_text(encoding='utf-8')) if _file.exists() else {}
+        for _file in (budget_file, timing_file)
+    ]
+    start = time.perf_counter()
+    results = [
+        check_bank(bank, args.dir, budgets, timings, args.update,
+                   args.regenerate) for bank in banks
+    ]
+    if args.update:
+        budget_file.write_text(json.dumps(budgets, ensure_ascii=False, indent=2),
+                               encoding='utf-8')
+    timing_file.write_text(json.dumps(timings, ensure_ascii=False, indent=2),
+                           encoding='utf-8')
+    print('检查完成，用时{:.1f}秒，通过{}家，未通过{}家'.format(
+        time.perf_counter() - start, sum(results),
+        len(results) - sum(results)))
+    return 0 if all(results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,164 @@
+import math
+import os
+import re
+import sys
 from typing import List, Dict, Union, Set
 
 TEST_HEADER = 3
+# 余额核对时允许的误差（元），金额以分为单位时精确比较
+BALANCE_TOLERANCE = 0.005
+# 以分为单位的金额类型（可含空值的int64），以及金额字符串的格式：
+# 可选的前置符号、整数部分、小数部分，以及平安银行等使用的后置负号
+FEN_DTYPE = 'Int64'
+FEN_PATTERN = r'^(?P<符号>[-+]?)(?=\.?\d)(?P<元>\d*)(?:\.(?P<角分>\d*))?(?P<后缀>-?)$'
 CHARGE_OFF_WORDS = {'付', '支出', '借', '借方', '出账', '转出', 'D', '0'}
 NONE_TRANS_WORDS = {'无交易', '在我行仅有信用卡账户'}
 COLUMN_ORDER = [
     '银行名称', '户名', '账号', '卡号', '交易日期', '借贷标志', '币种', '交易金额', '账户余额', '交易方式', 
     '备注', '摘要', '附言', '对方户名', '对方账号', '对方开户行', '交易场所', '交易地区', '交易网点', '柜员号',
-    '涉外交易代码', '交易代码', '代办人', '代办人证件'
+    '涉外交易代码', '交易代码', '代办人', '代办人证件', '收支存疑'
 ]
+# 单个工作簿按工作表并行解析：最大进程数、内存预算（字节），
+# 以及每个进程内存占用相对文件大小的估算倍数
+SHEET_WORKERS = os.cpu_count() or 1
+SHEET_MEMORY_BUDGET = 4 * 1024**3
+SHEET_MEMORY_FACTOR = 10
+# 工作表数和文件大小都达到以下数值时才并行解析
+SHEET_PARALLEL_MIN_SHEETS = 8
+SHEET_PARALLEL_MIN_SIZE = 10 * 1024**2
+# 受监控的文件解析：每个文件在子进程中解析的超时时间（秒）、子进程常驻内存上限（字节）、
+# 检查间隔（秒）、子进程正常退出后等待结果到达的时间（秒），以及失败文件单独重试的次数，
+# 仍失败的文件被隔离
+FILE_TIMEOUT = 600
+FILE_MEMORY_LIMIT = 4 * 1024**3
+FILE_POLL_INTERVAL = 0.05
+FILE_RESULT_WAIT = 5
+FILE_RETRIES = 1
+# 预读文件：预读线程数、最多预读的文件数、预读内容占用内存上限（字节）
+PREFETCH_THREADS = 2
+PREFETCH_DEPTH = 2
+PREFETCH_MEMORY = 512 * 1024**2
+# 分块写入CSV：每块行数、并行压缩线程数、已生成但尚未写完的分块文本总字节数上限、
+# gzip和zstd压缩级别
+CSV_CHUNK_ROWS = 1000000
+CSV_WORKERS = os.cpu_count() or 1
+CSV_MEMORY = 256 * 1024**2
+CSV_GZIP_LEVEL = 6
+CSV_ZSTD_LEVEL = 3
+# 账户表余额单元格中每行的币种和金额，如“美元12.50”
+BALANCE_PATTERN = re.compile(
+    r'^[ \t]*(?P<币种>[^\d\n-]*?)[ \t]*(?P<当前余额>-?[\d,]+(?:\.\d+)?)[^\d\n]*$',
+    re.M)
+# 建行账号后标注的币种，如“（美元）”
+ACCOUNT_CURRENCY_PATTERN = re.compile(r'^\s*\d+\s*(（[^）]+）)')
+# 币种写法到ISO代码的映射，查表前去除两端的括号和空白
+CURRENCY_DECO_CHARS = ' \t（）()【】[]'
+CURRENCY_ALIASES = {
+    '': 'CNY',
+    '人民币': 'CNY',
+    'RMB': 'CNY',
+    'CNY': 'CNY',
+    '156': 'CNY',
+    '¥': 'CNY',
+    '￥': 'CNY',
+    '美元': 'USD',
+    'USD': 'USD',
+    '$': 'USD',
+    '840': 'USD',
+    '港币': 'HKD',
+    '港元': 'HKD',
+    'HKD': 'HKD',
+    '344': 'HKD',
+    '欧元': 'EUR',
+    'EUR': 'EUR',
+    '978': 'EUR',
+    '日元': 'JPY',
+    'JPY': 'JPY',
+    '392': 'JPY',
+    '英镑': 'GBP',
+    'GBP': 'GBP',
+    '826': 'GBP',
+    '澳元': 'AUD',
+    '澳大利亚元': 'AUD',
+    'AUD': 'AUD',
+    '加元': 'CAD',
+    '加拿大元': 'CAD',
+    'CAD': 'CAD',
+    '新加坡元': 'SGD',
+    'SGD': 'SGD',
+    '瑞士法郎': 'CHF',
+    'CHF': 'CHF',
+}
+# 异常交易评分：滚动窗口天数（第1个用于判断高频，第2个用于判断资金过渡）
+ANOMALY_WINDOWS = [1, 7, 30]
+# 整额交易：金额不小于ROUND_AMOUNT_MIN且为ROUND_AMOUNT_UNIT的整数倍
+ROUND_AMOUNT_MIN = 10000
+ROUND_AMOUNT_UNIT = 1000
+# 高频交易：1天内的交易笔数
+HIGH_FREQUENCY_COUNT = 20
+# 大额现金：金额下限，以及在哪些字段中查找现金交易的关键字
+LARGE_CASH_AMOUNT = 50000
+CASH_COLS = ['交易方式', '摘要', '备注']
+CASH_PATTERN = '现金|现支|现存|取现|存现|ATM'
+# 快进快出：转出前若干小时内的转入金额不少于转出金额的比例
+PASS_THROUGH_HOURS = 24
+PASS_THROUGH_RATIO = 0.9
+# 资金过渡：窗口内收支比和支出金额的下限
+BALANCED_FLOW_RATIO = 0.9
+LARGE_FLOW_AMOUNT = 500000
+# 各项风险标记的分值
+ANOMALY_WEIGHTS = {'整额': 1, '高频': 1, '大额现金': 3, '快进快出': 3, '资金过渡': 2}
+# 资金追踪：默认追踪层数、每层时间窗口（小时）及金额允许误差比例
+TRACE_HOPS = 3
+TRACE_WINDOW_HOURS = 72
+TRACE_AMOUNT_TOLERANCE = 0.1
+# 模糊户名归并：规范化时的替换规则（按顺序替换）和删除的字符
+NAME_REPLACEMENTS = [('有限责任公司', '有限公司'), ('股份有限公司', '有限公司')]
+NAME_STRIP_PATTERN = r'[\s()（）\[\]【】"“”\'‘’.,，。、·\-_]'
+# 比较名称相似度前去除的组织形式后缀（规范化之后匹配，可连续出现，含被截断的“有限责任公”等），
+# 避免“有限公司”等共同部分抬高不同主体的相似度
+NAME_LEGAL_FORM_PATTERN = r'(?:(?:股份)?有限(?:责任)?(?:公司?)?|有限合伙|合伙企业|公司|集团)+$'
+# 字符n-gram长度，MinHash个数为NAME_LSH_BANDS * NAME_LSH_ROWS；
+# 同一LSH桶内每个名称最多与其后NAME_LSH_MAX_PAIRS个名称组成候选对（小桶即全部两两组合）
+NAME_NGRAM = 2
+NAME_LSH_BANDS = 10
+NAME_LSH_ROWS = 4
+NAME_LSH_MAX_PAIRS = 50
+# 候选对按n-gram集合的精确Jaccard相似度验证，不低于NAME_SIMILARITY的视为同一主体；
+# 去除组织形式后短于NAME_FUZZY_MIN_LENGTH的名称（多为个人姓名）只做精确匹配
+NAME_SIMILARITY = 0.7
+NAME_FUZZY_MIN_LENGTH = 4
+# 以Feather格式保存的规范流水文件名
+FEATHER_FILE_NAME = '规范交易流水（张楠制作）.feather'
+# 导入时生成的汇总表及其Feather文件名，以及每个账户保留的主要交易对手数
+SUMMARY_FILE_NAMES = {
+    '月度收支': '月度收支汇总（张楠制作）.feather',
+    '主要对手': '主要交易对手（张楠制作）.feather',
+}
+SUMMARY_TOP_K = 10
+# 流水来源列，源文件和源工作表为分类编码，源行号为工作表中的行号
+SOURCE_COLS = ['源文件', '源工作表', '源行号']
+# 识别未知目录的银行：抽样的文件数、每个文件抽样的工作表数、每个工作表读取的行数，
+# 以及至少命中的特征数
+DETECT_FILES = 3
+DETECT_SHEETS = 3
+DETECT_ROWS = 10
+DETECT_MIN_TOKENS = 2
+# 使用专门方法解析的银行没有列映射，以特有的工作表名和表头作为特征
+BANK_FINGERPRINTS = {
+    '中国银行': [
+        '新线交易', '新线账号', '新线流水', '旧线交易', '旧线账号', '旧账号', '20150701后交易',
+        '20120720后交易流水', '交易后可抵用金额', '柜员和分行', '交易发生日', '子账号'
+    ],
+    '建设银行': [
+        '个人活期明细信息-新一代', '个人定期明细信息-新一代', '企业活期明细信息', '企业定期明细信息',
+        '交易卡号', '借贷方标志', '交易备注'
+    ],
+    '邮储银行': ['对方账号/卡号/汇票号', '对方开户机构', '交易渠道', '交易机构名称'],
+    '宁夏银行': ['交易机构', '借贷标识', '对方名称', '对方行名'],
+    '平安银行': ['借方发生额', '贷方发生额', '交易对方户名', '交易对方账号', '交易对方行名称'],
+    '华夏银行': ['过账日期', '凭证号', '对方户名(或商户名称)', '对方账号(或商户编号)', '对方银行'],
+}
 # "银行业金融机构报告可疑交易逐笔明细表"的默认列映射
 COL_MAP_COMMON = {
     '资金收付标志': '借贷标志',
@@ -22,6 +173,10 @@ COL_MAP_COMMON = {
     '代办人身份证件/证明文件号码': '代办人证件',
     '资金来源和用途': '摘要'
 }
+# 判断重复交易所用的字段。户名和币种用于区分缺少账号和余额时不同持有人、不同币种的相同交易
+DUPLICATE_KEY_COLS = [
+    '户名', '账号', '卡号', '币种', '交易日期', '交易金额', '账户余额', '对方账号', '对方户名'
+]
 CHECK_COLS = {'银行名称', '户名', '借贷标志', '交易日期', '交易金额', '账户余额'}
 CHECK_COLS_COMMON = {'银行名称', '户名', '借贷标志', '交易日期', '交易金额'}
 CHECK_COLS_NO_SIGN = {'银行名称', '户名', '交易日期', '交易金额', '账户余额'}
@@ -73,317 +228,351 @@ class BankPara:
         self.need_cols = need_cols
 
 
-BANK_PARAS = {}
-BANK_PARAS['北京银行'] = BankPara(
-    col_map={
-        '帐号': '账号',
-        '资金收付标志': '借贷标志',
-        '金额': '交易金额',
-        '余额': '账户余额',
-        '交易对手姓名': '对方户名',
-        '交易对手帐号': '对方账号',
-        '交易对手金融机构名称': '对方开户行',
-        '开户银行机构名称': '交易网点',
-        '交易附言': '摘要'
-    },
-    sheet_name_is='户名',
-    footer=1,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码'}))
-BANK_PARAS['工商银行'] = BankPara(
-    col_map={
-        '帐号': '账号',
-        '服务界面': '交易方式',
-        '渠道': '交易方式',
-        '发生额': '交易金额',
-        '余额': '账户余额',
-        '对方帐户': '对方账号',
-        '对方开户行名': '对方开户行',
-        '对方行名': '对方开户行',
-        '交易地区号': '交易地区',
-        '交易网点号': '交易网点',
-        '注释': '备注',
-        '入账日期': '交易日期',
-        '入帐日期': '交易日期',
-        '交易金额': '金额',
-        '对方卡号/账号': '对方账号',
-        '对方帐号': '对方账号',
-        '对方帐户户名': '对方户名',
-        '更新后余额': '账户余额',
-        '交易柜员号': '柜员号',
-        '交易场所简称': '交易场所',
-        '交易描述': '备注',
-        '备注1': '备注',
-    },
-    has_nodata_sheets=True,
-    deco_strings='')
-BANK_PARAS['广发银行'] = BankPara(
-    col_map={
-        '客户名称': '户名',
-        '本方账号': '账号',
-        '本方交易介质': '卡号',
-        '交易渠道中文': '交易方式',
-        '借贷标识': '借贷标志',
-        '交易货币': '币种',
-        '当前余额': '账户余额',
-        '对手账号名称': '对方户名',
-        '对手账号行所号': '对方开户行',
-        '交易行': '交易网点',
-        '交易柜员': '柜员号',
-        '交易码中文': '交易代码',
-        '摘要中文': '摘要',
-    },
-    need_cols=NEED_COLS_WORDS)
-BANK_PARAS['哈尔滨银行'] = BankPara(
-    col_map={
-        '交易时间': '交易日期',
-        '渠道名称': '交易方式',
-        '借贷标识': '借贷标志',
-        '余额': '账户余额',
-        '币种名称': '币种',
-        '机构号': '交易网点',
-        '现转标识': '摘要',
-        '附言': '备注',
-    },
-    footer=5,
-    need_cols=(NEED_COLS - {'交易代码', '对方户名'}))
-BANK_PARAS['交通银行'] = BankPara(
-    col_map={
-        '主记账帐号': '账号',
-        '主名义账号': '卡号',
-        '金额': '交易金额',
-        '对方分行': '对方开户行',
-        '交易分行': '交易地区',
-        '交易网点/部门': '交易网点',
-        '交易柜员': '柜员号',
-        '业务摘要区': '摘要',
-        '帐号': '账号',
-        '交易机构所属分行': '交易地区',
-        '交易机构号': '交易网点',
-        '借贷方标志': '借贷标志',
-        '对方帐号': '对方账号',
-        '货币码': '币种',
-        '技术摘要': '摘要'
-    },
-    deco_strings='流水',
-    check_cols=CHECK_COLS_COMMON,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易方式', '摘要'}))
-BANK_PARAS['廊坊银行'] = BankPara(
-    col_map={
-        '客户账号': '账号',
-        '货币代号': '币种',
-        '产品说明': '交易方式',
-        '借方发生额': '交易金额',
-        '对方客户账号': '对方账号',
-        '营业机构': '交易网点',
-        '柜员代号': '柜员号',
-        '代理人姓名': '代办人',
-        '代理人证件号码': '代办人证件',
-        '摘要描述': '摘要',
-    },
-    second_amount_col='贷方发生额',
-    deco_strings='活期账户流水')
-BANK_PARAS['渤海银行'] = BankPara(
-    col_map=COL_MAP_COMMON,
-    deco_strings='报告可疑交易逐笔明细表—',
-    check_cols=CHECK_COLS_COMMON,
-    need_cols=(NEED_COLS - {'摘要'}))
-BANK_PARAS['光大银行'] = BankPara(
-    col_map=COL_MAP_COMMON,
-    deco_strings='交易明细',
-    check_cols=CHECK_COLS_COMMON)
-BANK_PARAS['河北银行'] = BankPara(
-    col_map=COL_MAP_COMMON,
-    deco_strings='：银行业金融机构报告可疑交易逐笔明细表',
-    check_cols=CHECK_COLS_COMMON)
-BANK_PARAS['民生银行'] = BankPara(
-    col_map={
-        '客户姓名': '户名',
-        '客户账户': '账号',
-        '客户账号': '账号',
-        '原币交易金额': '交易金额',
-        '对方名称': '对方户名',
-        '对方银行名称': '对方开户行'
-    },
-    check_cols=CHECK_COLS_COMMON,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易网点', '交易方式'}))
-BANK_PARAS['浦发银行'] = BankPara(
-    col_map={
-        '调查户名': '户名',
-        '0(支出)/1（收入）': '借贷标志',
-        '金额': '交易金额',
-        '对方开户银行': '对方开户行',
-        '开户银行': '交易网点',
-    },
-    check_cols=CHECK_COLS_COMMON,
-    need_cols=(NEED_COLS - {'交易代码', '摘要'}))
-BANK_PARAS['天津农商银行'] = BankPara(
-    col_map=COL_MAP_COMMON,
-    deco_strings='银行业金融机构报告可疑交易逐笔明细表——',
-    check_cols=CHECK_COLS_COMMON)
-BANK_PARAS['天津银行'] = BankPara(
-    col_map={
-        '姓名': '户名',
-        '资金收付标志': '借贷标志',
-        ' 交易额(按原币计)（元）': '交易金额',
-        '交易对手姓名或名称': '对方户名',
-        '交易对手账号': '对方账号',
-        '对方金融机构网点名称': '对方开户行',
-        '金融机构名称': '交易网点',
-        '涉外收支交易分类与代码': '涉外交易代码',
-        '业务标示号': '交易代码',
-        '代办人姓名': '代办人',
-        '代办人身份证件/证明文件号码': '代办人证件',
-        '资金来源和用途': '摘要'
-    },
-    has_empty_sheets=True,
-    check_cols=CHECK_COLS_COMMON,
-    need_cols=NEED_COLS_NO_REMARKS)
-BANK_PARAS['兴业银行'] = BankPara(
-    col_map={
-        '交易机构编号': '交易网点',
-        '交易名称': '备注',
-        '渠道类型代码': '交易方式',
-        '帐号': '账号',
-        '对手帐号': '对方账号',
-        '对手账号': '对方账号',
-        '对手户名': '对方户名',
-        '对手开户行': '对方开户行',
-        '摘要描述': '摘要',
-        '柜员流水号': '柜员号'
-    },
-    deco_strings='')
-BANK_PARAS['渣打银行'] = BankPara(
-    col_map=COL_MAP_COMMON,
-    deco_strings='',
-    footer=1,
-    check_cols=CHECK_COLS_COMMON)
-BANK_PARAS['中信银行'] = BankPara(
-    col_map={
-        '交易码': '交易代码',
-        '借贷类型代码': '借贷标志',
-        '通用对方客户账号': '对方账号',
-        '对方账户名称': '对方户名',
-        '对方行名称': '对方开户行',
-        '客户账号': '账号',
-        '客户名称': '户名',
-        '核心交易代码': '交易代码',
-        '币种中文': '币种',
-        '交易用户名': '柜员号',
-    },
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易网点', '交易方式'}))
-BANK_PARAS['招商银行'] = BankPara(
-    col_map={
-        '客户名称': '户名',
-        '交易卡号': '账号',
-        '联机余额': '账户余额',
-        '交易摘要': '摘要',
-        '文字摘要': '备注',
-        '对手帐号': '对方账号',
-        '对手名称': '对方户名',
-        '对手开户行': '对方开户行',
-        '我方摘要': '摘要',
-        '对方开户机构名称': '对方开户行',
-        '对方客户名称': '对方户名',
-        '业务编号': '账号',
-        '对方业务编号': '对方账号',
-        '交易机构': '交易网点',
-    },
-    has_minus_amounts=True,
-    deco_strings='',
-    use_dir_name=True,
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols=(NEED_COLS - {'交易代码', '交易方式', '交易网点'}))
-BANK_PARAS['农业银行'] = BankPara(
-    col_map={
-        '合约号': '账号',
-        '产品号': '卡号',
-        '合约外部服务标识号码': '卡号',
-        '合约名称': '户名',
-        '借方交易金额': '交易金额',
-        '借方金额': '交易金额',
-        '贷方金额': '贷方交易金额',
-        '交易金额借方': '交易金额',
-        '交易金额贷方': '贷方交易金额',
-        '贷方交易金额_1': '贷方交易金额',
-        '贷方交易金额_': '贷方交易金额',
-        '交易后余额': '账户余额',
-        '合约账户余额1': '账户余额',
-        '合约账户余额': '账户余额',
-        '对方银行': '对方开户行',
-        '对方开户银行': '对方开户行',
-        '交易对手账号': '对方账号',
-        '对方名称': '对方户名',
-        '交易渠道': '交易方式',
-        '渠道代码': '交易方式',
-        '摘要信息': '摘要',
-        '记账方向标识_1': '借贷标志',
-        '交易地点': '交易网点',
-        '对方省市代号': '交易地区',
-    },
-    second_amount_col='贷方交易金额',
-    footer=1,
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易网点'}))
-BANK_PARAS['威海银行'] = BankPara(
-    col_map={
-        '币别': '币种',
-        '借方发生额': '交易金额',
-        '交易渠道': '交易方式',
-        '交易机构名称': '交易网点',
-        '摘要代码': '摘要',
-        '对方名称': '对方户名',
-        '交易对方行名': '对方开户行',
-        '交易类别': '附言',
-    },
-    sheet_name_is='账号',
-    deco_strings='流水',
-    second_amount_col='贷方发生额',
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols=(NEED_COLS_WORDS - {'交易代码'}))
-BANK_PARAS['中国银行'] = BankPara(
-    special_func='中国银行',
-    need_cols=NEED_COLS_NO_REMARKS)
-BANK_PARAS['建设银行'] = BankPara(
-    special_func='建设银行',
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols=(NEED_COLS - {'交易代码'}))
-BANK_PARAS['邮储银行'] = BankPara(
-    special_func='邮储银行',
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols=(NEED_COLS - {'对方户名', '交易代码', '备注'}))
-BANK_PARAS['平安银行'] = BankPara(
-    special_func='平安银行',
-    second_amount_col='贷方发生额',
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易方式'}))
-BANK_PARAS['华夏银行'] = BankPara(
-    special_func='华夏银行',
-    check_cols=CHECK_COLS,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易网点'}))
-BANK_PARAS['锦州银行'] = BankPara(
-    col_map={
-        '交易地点': '交易网点',
-        '交易说明': '摘要',
-        '支出': '交易金额',
-        '交易柜员': '柜员号',
-        '余额': '账户余额',
-    },
-    second_amount_col='存入',
-    check_cols=CHECK_COLS_NO_SIGN,
-    need_cols={'对方户名', '摘要'})
-BANK_PARAS['宁夏银行'] = BankPara(
-    special_func='宁夏银行',
-    check_cols=CHECK_COLS,
-    need_cols=(NEED_COLS_NO_REMARKS - {'交易代码'}))
-BANK_PARAS['津南村镇银行'] = BankPara(
-    col_map={
-        '交易机构': '交易网点',
-        '交易名称': '摘要',
-        'TRCASH': '交易方式',
-        '交易柜员': '柜员号',
-        'DRCRIND': '借贷标志',
-        '客户名称': '户名',
-    },
-    skip_files='*大小额明细*',
-    check_cols=CHECK_COLS_COMMON,
-    need_cols={'交易方式', '摘要', '备注'})
+# 各银行的解析参数，首次访问BANK_PARAS时才生成
+def build_bank_paras() -> Dict[str, BankPara]:
+    bank_paras = {}
+    bank_paras['北京银行'] = BankPara(
+        col_map={
+            '帐号': '账号',
+            '资金收付标志': '借贷标志',
+            '金额': '交易金额',
+            '余额': '账户余额',
+            '交易对手姓名': '对方户名',
+            '交易对手帐号': '对方账号',
+            '交易对手金融机构名称': '对方开户行',
+            '开户银行机构名称': '交易网点',
+            '交易附言': '摘要'
+        },
+        sheet_name_is='户名',
+        footer=1,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码'}))
+    bank_paras['工商银行'] = BankPara(
+        col_map={
+            '帐号': '账号',
+            '服务界面': '交易方式',
+            '渠道': '交易方式',
+            '发生额': '交易金额',
+            '余额': '账户余额',
+            '对方帐户': '对方账号',
+            '对方开户行名': '对方开户行',
+            '对方行名': '对方开户行',
+            '交易地区号': '交易地区',
+            '交易网点号': '交易网点',
+            '注释': '备注',
+            '入账日期': '交易日期',
+            '入帐日期': '交易日期',
+            '交易金额': '金额',
+            '对方卡号/账号': '对方账号',
+            '对方帐号': '对方账号',
+            '对方帐户户名': '对方户名',
+            '更新后余额': '账户余额',
+            '交易柜员号': '柜员号',
+            '交易场所简称': '交易场所',
+            '交易描述': '备注',
+            '备注1': '备注',
+        },
+        has_nodata_sheets=True,
+        deco_strings='')
+    bank_paras['广发银行'] = BankPara(
+        col_map={
+            '客户名称': '户名',
+            '本方账号': '账号',
+            '本方交易介质': '卡号',
+            '交易渠道中文': '交易方式',
+            '借贷标识': '借贷标志',
+            '交易货币': '币种',
+            '当前余额': '账户余额',
+            '对手账号名称': '对方户名',
+            '对手账号行所号': '对方开户行',
+            '交易行': '交易网点',
+            '交易柜员': '柜员号',
+            '交易码中文': '交易代码',
+            '摘要中文': '摘要',
+        },
+        need_cols=NEED_COLS_WORDS)
+    bank_paras['哈尔滨银行'] = BankPara(
+        col_map={
+            '交易时间': '交易日期',
+            '渠道名称': '交易方式',
+            '借贷标识': '借贷标志',
+            '余额': '账户余额',
+            '币种名称': '币种',
+            '机构号': '交易网点',
+            '现转标识': '摘要',
+            '附言': '备注',
+        },
+        footer=5,
+        need_cols=(NEED_COLS - {'交易代码', '对方户名'}))
+    bank_paras['交通银行'] = BankPara(
+        col_map={
+            '主记账帐号': '账号',
+            '主名义账号': '卡号',
+            '金额': '交易金额',
+            '对方分行': '对方开户行',
+            '交易分行': '交易地区',
+            '交易网点/部门': '交易网点',
+            '交易柜员': '柜员号',
+            '业务摘要区': '摘要',
+            '帐号': '账号',
+            '交易机构所属分行': '交易地区',
+            '交易机构号': '交易网点',
+            '借贷方标志': '借贷标志',
+            '对方帐号': '对方账号',
+            '货币码': '币种',
+            '技术摘要': '摘要'
+        },
+        deco_strings='流水',
+        check_cols=CHECK_COLS_COMMON,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易方式', '摘要'}))
+    bank_paras['廊坊银行'] = BankPara(
+        col_map={
+            '客户账号': '账号',
+            '货币代号': '币种',
+            '产品说明': '交易方式',
+            '借方发生额': '交易金额',
+            '对方客户账号': '对方账号',
+            '营业机构': '交易网点',
+            '柜员代号': '柜员号',
+            '代理人姓名': '代办人',
+            '代理人证件号码': '代办人证件',
+            '摘要描述': '摘要',
+        },
+        second_amount_col='贷方发生额',
+        deco_strings='活期账户流水')
+    bank_paras['渤海银行'] = BankPara(
+        col_map=COL_MAP_COMMON,
+        deco_strings='报告可疑交易逐笔明细表—',
+        check_cols=CHECK_COLS_COMMON,
+        need_cols=(NEED_COLS - {'摘要'}))
+    bank_paras['光大银行'] = BankPara(
+        col_map=COL_MAP_COMMON,
+        deco_strings='交易明细',
+        check_cols=CHECK_COLS_COMMON)
+    bank_paras['河北银行'] = BankPara(
+        col_map=COL_MAP_COMMON,
+        deco_strings='：银行业金融机构报告可疑交易逐笔明细表',
+        check_cols=CHECK_COLS_COMMON)
+    bank_paras['民生银行'] = BankPara(
+        col_map={
+            '客户姓名': '户名',
+            '客户账户': '账号',
+            '客户账号': '账号',
+            '原币交易金额': '交易金额',
+            '对方名称': '对方户名',
+            '对方银行名称': '对方开户行'
+        },
+        check_cols=CHECK_COLS_COMMON,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易网点', '交易方式'}))
+    bank_paras['浦发银行'] = BankPara(
+        col_map={
+            '调查户名': '户名',
+            '0(支出)/1（收入）': '借贷标志',
+            '金额': '交易金额',
+            '对方开户银行': '对方开户行',
+            '开户银行': '交易网点',
+        },
+        check_cols=CHECK_COLS_COMMON,
+        need_cols=(NEED_COLS - {'交易代码', '摘要'}))
+    bank_paras['天津农商银行'] = BankPara(
+        col_map=COL_MAP_COMMON,
+        deco_strings='银行业金融机构报告可疑交易逐笔明细表——',
+        check_cols=CHECK_COLS_COMMON)
+    bank_paras['天津银行'] = BankPara(
+        col_map={
+            '姓名': '户名',
+            '资金收付标志': '借贷标志',
+            ' 交易额(按原币计)（元）': '交易金额',
+            '交易对手姓名或名称': '对方户名',
+            '交易对手账号': '对方账号',
+            '对方金融机构网点名称': '对方开户行',
+            '金融机构名称': '交易网点',
+            '涉外收支交易分类与代码': '涉外交易代码',
+            '业务标示号': '交易代码',
+            '代办人姓名': '代办人',
+            '代办人身份证件/证明文件号码': '代办人证件',
+            '资金来源和用途': '摘要'
+        },
+        has_empty_sheets=True,
+        check_cols=CHECK_COLS_COMMON,
+        need_cols=NEED_COLS_NO_REMARKS)
+    bank_paras['兴业银行'] = BankPara(
+        col_map={
+            '交易机构编号': '交易网点',
+            '交易名称': '备注',
+            '渠道类型代码': '交易方式',
+            '帐号': '账号',
+            '对手帐号': '对方账号',
+            '对手账号': '对方账号',
+            '对手户名': '对方户名',
+            '对手开户行': '对方开户行',
+            '摘要描述': '摘要',
+            '柜员流水号': '柜员号'
+        },
+        deco_strings='')
+    bank_paras['渣打银行'] = BankPara(
+        col_map=COL_MAP_COMMON,
+        deco_strings='',
+        footer=1,
+        check_cols=CHECK_COLS_COMMON)
+    bank_paras['中信银行'] = BankPara(
+        col_map={
+            '交易码': '交易代码',
+            '借贷类型代码': '借贷标志',
+            '通用对方客户账号': '对方账号',
+            '对方账户名称': '对方户名',
+            '对方行名称': '对方开户行',
+            '客户账号': '账号',
+            '客户名称': '户名',
+            '核心交易代码': '交易代码',
+            '币种中文': '币种',
+            '交易用户名': '柜员号',
+        },
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易网点', '交易方式'}))
+    bank_paras['招商银行'] = BankPara(
+        col_map={
+            '客户名称': '户名',
+            '交易卡号': '账号',
+            '联机余额': '账户余额',
+            '交易摘要': '摘要',
+            '文字摘要': '备注',
+            '对手帐号': '对方账号',
+            '对手名称': '对方户名',
+            '对手开户行': '对方开户行',
+            '我方摘要': '摘要',
+            '对方开户机构名称': '对方开户行',
+            '对方客户名称': '对方户名',
+            '业务编号': '账号',
+            '对方业务编号': '对方账号',
+            '交易机构': '交易网点',
+        },
+        has_minus_amounts=True,
+        deco_strings='',
+        use_dir_name=True,
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols=(NEED_COLS - {'交易代码', '交易方式', '交易网点'}))
+    bank_paras['农业银行'] = BankPara(
+        col_map={
+            '合约号': '账号',
+            '产品号': '卡号',
+            '合约外部服务标识号码': '卡号',
+            '合约名称': '户名',
+            '借方交易金额': '交易金额',
+            '借方金额': '交易金额',
+            '贷方金额': '贷方交易金额',
+            '交易金额借方': '交易金额',
+            '交易金额贷方': '贷方交易金额',
+            '贷方交易金额_1': '贷方交易金额',
+            '贷方交易金额_': '贷方交易金额',
+            '交易后余额': '账户余额',
+            '合约账户余额1': '账户余额',
+            '合约账户余额': '账户余额',
+            '对方银行': '对方开户行',
+            '对方开户银行': '对方开户行',
+            '交易对手账号': '对方账号',
+            '对方名称': '对方户名',
+            '交易渠道': '交易方式',
+            '渠道代码': '交易方式',
+            '摘要信息': '摘要',
+            '记账方向标识_1': '借贷标志',
+            '交易地点': '交易网点',
+            '对方省市代号': '交易地区',
+        },
+        second_amount_col='贷方交易金额',
+        footer=1,
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易网点'}))
+    bank_paras['威海银行'] = BankPara(
+        col_map={
+            '币别': '币种',
+            '借方发生额': '交易金额',
+            '交易渠道': '交易方式',
+            '交易机构名称': '交易网点',
+            '摘要代码': '摘要',
+            '对方名称': '对方户名',
+            '交易对方行名': '对方开户行',
+            '交易类别': '附言',
+        },
+        sheet_name_is='账号',
+        deco_strings='流水',
+        second_amount_col='贷方发生额',
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols=(NEED_COLS_WORDS - {'交易代码'}))
+    bank_paras['中国银行'] = BankPara(
+        special_func='中国银行',
+        need_cols=NEED_COLS_NO_REMARKS)
+    bank_paras['建设银行'] = BankPara(
+        special_func='建设银行',
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols=(NEED_COLS - {'交易代码'}))
+    bank_paras['邮储银行'] = BankPara(
+        special_func='邮储银行',
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols=(NEED_COLS - {'对方户名', '交易代码', '备注'}))
+    bank_paras['平安银行'] = BankPara(
+        special_func='平安银行',
+        second_amount_col='贷方发生额',
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易方式'}))
+    bank_paras['华夏银行'] = BankPara(
+        special_func='华夏银行',
+        check_cols=CHECK_COLS,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码', '交易网点'}))
+    bank_paras['锦州银行'] = BankPara(
+        col_map={
+            '交易地点': '交易网点',
+            '交易说明': '摘要',
+            '支出': '交易金额',
+            '交易柜员': '柜员号',
+            '余额': '账户余额',
+        },
+        second_amount_col='存入',
+        check_cols=CHECK_COLS_NO_SIGN,
+        need_cols={'对方户名', '摘要'})
+    bank_paras['宁夏银行'] = BankPara(
+        special_func='宁夏银行',
+        check_cols=CHECK_COLS,
+        need_cols=(NEED_COLS_NO_REMARKS - {'交易代码'}))
+    bank_paras['津南村镇银行'] = BankPara(
+        col_map={
+            '交易机构': '交易网点',
+            '交易名称': '摘要',
+            'TRCASH': '交易方式',
+            '交易柜员': '柜员号',
+            'DRCRIND': '借贷标志',
+            '客户名称': '户名',
+        },
+        skip_files='*大小额明细*',
+        check_cols=CHECK_COLS_COMMON,
+        need_cols={'交易方式', '摘要', '备注'})
+    return bank_paras
+
+
+# 由各银行的列映射原列名和BANK_FINGERPRINTS生成倒排索引{特征: {银行: 权重}}，
+# 权重为逆文档频率，多家银行共有的特征权重低
+def build_bank_index() -> Dict[str, Dict[str, float]]:
+    bank_tokens = {
+        name: {col.strip() for col in (para.col_map or {})}
+        for name, para in sys.modules[__name__].BANK_PARAS.items()
+    }
+    for name, tokens in BANK_FINGERPRINTS.items():
+        bank_tokens[name].update(tokens)
+    bank_index = {}
+    for name, tokens in bank_tokens.items():
+        for token in tokens:
+            bank_index.setdefault(token, {})[name] = 0
+    for token, banks in bank_index.items():
+        idf = math.log(len(bank_tokens) / len(banks)) + 1
+        for name in banks:
+            banks[name] = idf
+    return bank_index
+
+
+def __getattr__(name: str):
+    if name == 'BANK_PARAS':
+        globals()['BANK_PARAS'] = build_bank_paras()
+        return globals()['BANK_PARAS']
+    if name == 'BANK_INDEX':
+        globals()['BANK_INDEX'] = build_bank_index()
+        return globals()['BANK_INDEX']
+    raise AttributeError('module {!r} has no attribute {!r}'.format(
+        __name__, name))